@@ -14,9 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from array import array
 from collections import defaultdict, namedtuple
-from struct import unpack_from, calcsize, pack
+from contextvars import ContextVar
+from itertools import chain
+from struct import unpack_from, calcsize, pack, pack_into
 from enum import Enum, IntEnum
+from sys import byteorder
+import warnings
 
 from .pyffi.utils import tristrip
 
@@ -37,9 +42,10 @@ BumpMapFX     = namedtuple("BumpMapFX"     , "intensity bump_map height_map")
 EnvMapFX      = namedtuple("EnvMapFX"      , "coefficient use_fb_alpha env_map")
 DualFX        = namedtuple("DualFX"        , "src_blend dst_blend texture")
 ReflMat       = namedtuple("ReflMat"       , "s_x s_y o_x o_y intensity")
-SpecularMat   = namedtuple("SpecularMap"   , "level texture")
+SpecularMat   = namedtuple("SpecularMat"   , "level texture")
 GeomBone      = namedtuple("GeomBone"      , "start_vertex vertices_count bone_id")
 RightToRender = namedtuple("RightToRender" , "value1 value2")
+SplitHeader   = namedtuple("SplitHeader"   , "indices_count material")
 
 TexDict = namedtuple("TexDict", "texture_count device_id")
 PITexDict = namedtuple("PITexDict", "texture_count device_id")
@@ -178,8 +184,15 @@ class Sections:
         PITexDict: "<2H"
     }
 
-    library_id = 0 # used for writing
-    
+    # Array typecode and number of items per element for the above data
+    # types that are stored in a PackedList
+    packed_formats = {
+        Vector    : ("f", 3),
+        RGBA      : ("B", 4),
+        TexCoords : ("f", 2),
+        Triangle  : ("H", 4),
+    }
+
     #######################################################
     def read(type, data, offset=0):
 
@@ -241,14 +254,44 @@ class Sections:
 
     #######################################################
     def write_chunk(data, type):
-        return pack("<III", type, len(data), Sections.library_id) + data
+        return pack("<III", type, len(data), WriterContext.current().library_id) + data
+
+    #######################################################
+    def begin_chunk(data, type):
+
+        # Appends a chunk header to data and returns where the chunk's
+        # contents start. The size is filled in by end_chunk, so nested
+        # chunks can be written into one buffer without copying them.
+        data += pack("<III", type, 0, WriterContext.current().library_id)
+        return len(data)
+
+    #######################################################
+    def end_chunk(data, start):
+        pack_into("<I", data, start - 8, len(data) - start)
+
+    #######################################################
+    def write_array(type, items):
+
+        # Packs a whole list of one of the packed_formats types at once
+        typecode, stride = Sections.packed_formats[type]
+
+        if isinstance(items, PackedList):
+            if byteorder == "little":
+                return items.array.tobytes()
+
+            _array = array(typecode, items.array)
+            _array.byteswap()
+            return _array.tobytes()
+
+        return pack("<%d%s" % (len(items) * stride, typecode),
+                    *chain.from_iterable(items))
         
      ########################################################
     def get_rw_version(library_id=None):
         #see https://gtamods.com/wiki/RenderWare
 
         if library_id is None:
-            library_id = Sections.library_id
+            return WriterContext.current().rw_version
         
         if library_id & 0xFFFF0000:
             return (library_id >> 14 & 0x3FF00) + 0x30000 | \
@@ -268,8 +311,124 @@ class Sections:
 
     #######################################################
     def set_library_id(version, build):
-        Sections.library_id = Sections.get_library_id(version,build)
-        
+
+        # Legacy, nothing in the addon calls it anymore. Sets the library id
+        # for the rest of the current thread (or task) with no way to go
+        # back to the previous one, so write inside a WriterContext instead.
+        warnings.warn(
+            "Sections.set_library_id is deprecated, write inside a WriterContext",
+            DeprecationWarning,
+            stacklevel=2
+        )
+        WriterContext._current.set(WriterContext(version, build))
+
+#######################################################
+class WriterContext:
+
+    # Library id that chunk headers are written with. Every thread (and
+    # asyncio task) sees its own active context, so several DFFs and TXDs
+    # can be serialized at once, each for its own RW version:
+    #
+    #   data = bytearray()
+    #   with WriterContext(0x36003):
+    #       dff.write_clump(data)
+
+    __slots__ = ['library_id', 'rw_version', '_tokens']
+
+    _current = ContextVar("rw_writer_context")
+
+    #######################################################
+    def __init__(self, version=0, build=0xFFFF):
+        self.library_id = Sections.get_library_id(version, build)
+        self.rw_version = Sections.get_rw_version(self.library_id)
+        self._tokens = []
+
+    #######################################################
+    @staticmethod
+    def current():
+        return WriterContext._current.get(_default_writer_context)
+
+    #######################################################
+    def __enter__(self):
+        self._tokens.append(WriterContext._current.set(self))
+        return self
+
+    #######################################################
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        WriterContext._current.reset(self._tokens.pop())
+
+_default_writer_context = WriterContext()
+
+#######################################################
+class PackedList:
+
+    # A list of namedtuples stored in a single flat typed array. Vertex
+    # streams are read into it with one copy instead of one unpack call and
+    # one namedtuple per element, while indexing and iterating still give
+    # the namedtuples the rest of the code expects.
+
+    __slots__ = [
+        'type',
+        'stride',
+        'array'
+    ]
+
+    #######################################################
+    def __init__(self, type, items=()):
+        typecode, self.stride = Sections.packed_formats[type]
+
+        self.type  = type
+        self.array = array(typecode)
+        self.extend(items)
+
+    #######################################################
+    @staticmethod
+    def from_mem(type, data, offset, count):
+
+        self = PackedList(type)
+
+        size = count * self.stride * self.array.itemsize
+        self.array.frombytes(data[offset:offset+size])
+
+        # RenderWare data is little endian
+        if byteorder != "little":
+            self.array.byteswap()
+
+        return self
+
+    #######################################################
+    def append(self, item):
+        self.array.extend(item)
+
+    #######################################################
+    def extend(self, items):
+        for item in items:
+            self.array.extend(item)
+
+    #######################################################
+    def __len__(self):
+        return len(self.array) // self.stride
+
+    #######################################################
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("PackedList index out of range")
+
+        pos = index * self.stride
+        return self.type._make(self.array[pos:pos+self.stride])
+
+    #######################################################
+    def __iter__(self):
+        components = (self.array[i::self.stride] for i in range(self.stride))
+        return map(self.type._make, zip(*components))
+
 #######################################################
 class Texture:
 
@@ -300,19 +459,23 @@ class Texture:
         return self
 
     #######################################################
-    def to_mem(self):
+    def to_mem(self, data=None):
 
-        data = bytearray()
-        data += pack("<2B2x", self.filters, self.uv_addressing)
+        if data is None:
+            data = bytearray()
 
-        data  = Sections.write_chunk(data, types["Struct"])
+        start = Sections.begin_chunk(data, types["Texture"])
+
+        data += Sections.write_chunk(pack("<2B2x", self.filters, self.uv_addressing),
+                                     types["Struct"])
         data += Sections.write_chunk(Sections.pad_string(self.name),
                                      types["String"])
         data += Sections.write_chunk(Sections.pad_string(self.mask),
                                      types["String"])
         data += Sections.write_chunk(bytearray(), types["Extension"])
 
-        return Sections.write_chunk(data, types["Texture"])
+        Sections.end_chunk(data, start)
+        return data
 
 #######################################################
 class Material:
@@ -377,54 +540,53 @@ class Material:
             self.plugins[key].append(plugin)
 
     #######################################################
-    def bumpfx_to_mem(self):
+    def bumpfx_to_mem(self, data):
 
-        data = bytearray()
         bump_map = self.plugins['bump_map'][0]
         
         data += pack("<IfI", 1, bump_map.intensity, bump_map.bump_map is not None)
         if bump_map.bump_map is not None:
-            data += bump_map.bump_map.to_mem()
+            bump_map.bump_map.to_mem(data)
 
         data += pack("<I", bump_map.height_map is not None)
         if bump_map.height_map is not None:
-            data += bump_map.height_map.to_mem()
+            bump_map.height_map.to_mem(data)
 
         return data
 
     #######################################################
-    def envfx_to_mem(self):
+    def envfx_to_mem(self, data):
         env_map = self.plugins['env_map'][0]
         
-        data = pack("<IfII",
-                    2,
-                    env_map.coefficient,
-                    env_map.use_fb_alpha,
-                    env_map.env_map is not None
+        data += pack("<IfII",
+                     2,
+                     env_map.coefficient,
+                     env_map.use_fb_alpha,
+                     env_map.env_map is not None
         )
         if env_map.env_map is not None:
-            data += env_map.env_map.to_mem()
+            env_map.env_map.to_mem(data)
 
         return data
 
     #######################################################
-    def dualfx_to_mem(self):
+    def dualfx_to_mem(self, data):
         dual_fx = self.plugins['dual'][0]
         
-        data = pack("<IIII",
-                    4,
-                    dual_fx.src_blend,
-                    dual_fx.dst_blend,
-                    dual_fx.texture is not None
+        data += pack("<IIII",
+                     4,
+                     dual_fx.src_blend,
+                     dual_fx.dst_blend,
+                     dual_fx.texture is not None
         )
         if dual_fx.texture is not None:
-            data += dual_fx.texture.to_mem()
+            dual_fx.texture.to_mem(data)
 
         return data
 
     #######################################################
-    def plugins_to_mem(self):
-        data = self.matfx_to_mem()
+    def plugins_to_mem(self, data):
+        self.matfx_to_mem(data)
 
         # Specular Material
         if 'spec' in self.plugins:
@@ -444,21 +606,28 @@ class Material:
 
         # UV Animation PLG
         if 'uv_anim' in self.plugins:
-            _data = pack("<I", (1 << len(self.plugins['uv_anim'])) - 1) #bitmask
+            start = Sections.begin_chunk(data, types["UV Animation PLG"])
+            struct_start = Sections.begin_chunk(data, types["Struct"])
+
+            data += pack("<I", (1 << len(self.plugins['uv_anim'])) - 1) #bitmask
             for frame_name in self.plugins['uv_anim']:
-                _data += pack("<32s", frame_name.encode('ascii'))
+                data += pack("<32s", frame_name.encode('ascii'))
 
-            _data = Sections.write_chunk(_data, types["Struct"])
-            data += Sections.write_chunk(_data, types["UV Animation PLG"])
+            Sections.end_chunk(data, struct_start)
+            Sections.end_chunk(data, start)
 
         if 'udata' in self.plugins:
-            data += self.plugins['udata'][0].to_mem()
+            self.plugins['udata'][0].to_mem(data)
             
         return data
     
     #######################################################
-    def matfx_to_mem(self):
-        data = bytearray()
+    def matfx_to_mem(self, data):
+
+        # The effect type goes first, but is only known once the effects
+        # are written, so it is filled in afterwards
+        start = Sections.begin_chunk(data, types["Material Effects PLG"])
+        data += pack("<I", 0)
         effectType = 0
         
         if 'dual' in self.plugins or 'uv_anim' in self.plugins:  
@@ -471,7 +640,7 @@ class Material:
                 else:  
                     # Both present and dual texture is not empty  
                     data += pack("<I", 5)  
-                    data += self.dualfx_to_mem()  
+                    self.dualfx_to_mem(data)  
                     effectType = 6  
             elif 'dual' in self.plugins:  
                 dual_fx = self.plugins['dual'][0]  
@@ -479,7 +648,7 @@ class Material:
                     # Dual texture is empty, don't export anything  
                     effectType = 0  
                 else:  
-                    data += self.dualfx_to_mem()  
+                    self.dualfx_to_mem(data)  
                     effectType = 4  
             else:  
                 data += pack("<I", 5)  
@@ -487,49 +656,61 @@ class Material:
         
         elif 'bump_map' in self.plugins or 'env_map' in self.plugins:
             if 'bump_map' in self.plugins and 'env_map' in self.plugins:
-                data += self.bumpfx_to_mem()
-                data += self.envfx_to_mem()
+                self.bumpfx_to_mem(data)
+                self.envfx_to_mem(data)
                 effectType = 3
             elif 'bump_map' in self.plugins:
-                data += self.bumpfx_to_mem()
+                self.bumpfx_to_mem(data)
                 effectType = 1
             else:
-                data += self.envfx_to_mem()
+                self.envfx_to_mem(data)
                 effectType = 2
 
         if effectType == 0:
             self._hasMatFX = False
-            return bytearray()
+            del data[start - 12:]
+            return data
         
         if effectType not in (3, 6):
             data += pack("<I", 0)
 
         self._hasMatFX = True
-        data = pack("<I", effectType) + data
-        return Sections.write_chunk(data, types["Material Effects PLG"])
+        pack_into("<I", data, start, effectType)
+        Sections.end_chunk(data, start)
+        return data
         
     #######################################################
-    def to_mem(self):
+    def to_mem(self, data=None):
 
-        data = pack("<4x")
+        if data is None:
+            data = bytearray()
+
+        start = Sections.begin_chunk(data, types["Material"])
+        struct_start = Sections.begin_chunk(data, types["Struct"])
+
+        data += pack("<4x")
         data += Sections.write(RGBA, self.color)
         data += pack("<II", 1, len(self.textures) > 0)
 
         if Sections.get_rw_version() > 0x30400:
             data += Sections.write(GeomSurfPro, self.surface_properties)
 
-        data = Sections.write_chunk(data, types["Struct"])
+        Sections.end_chunk(data, struct_start)
 
         # Only 1 texture is supported (I think)
         if len(self.textures) > 0:
-            data += self.textures[0].to_mem()
+            self.textures[0].to_mem(data)
 
-        data += Sections.write_chunk(self.plugins_to_mem(), types["Extension"])
-        return Sections.write_chunk(data, types["Material"])
+        ext_start = Sections.begin_chunk(data, types["Extension"])
+        self.plugins_to_mem(data)
+        Sections.end_chunk(data, ext_start)
+
+        Sections.end_chunk(data, start)
+        return data
 
     #######################################################
     def __hash__(self):
-        return hash(self.to_mem())
+        return hash(bytes(self.to_mem()))
 
 #######################################################
 class Atomic:
@@ -631,8 +812,12 @@ class UserData:
         return self
 
     #######################################################
-    def to_mem (self):
-        data = bytearray()
+    def to_mem (self, data=None):
+
+        if data is None:
+            data = bytearray()
+
+        start = Sections.begin_chunk(data, types["User Data PLG"])
 
         data += pack("<I", len(self.sections))
         for section in self.sections:
@@ -663,7 +848,8 @@ class UserData:
                 for string in section.data:
                     data += pack("<I%ds" % len(string), len(string), string.encode("ascii"))
 
-        return Sections.write_chunk(data, types["User Data PLG"])
+        Sections.end_chunk(data, start)
+        return data
 
 #######################################################
 class Frame:
@@ -712,22 +898,26 @@ class Frame:
         return data
 
     #######################################################
-    def extensions_to_mem(self):
+    def extensions_to_mem(self, data=None):
 
-        data = bytearray()
+        if data is None:
+            data = bytearray()
+
+        start = Sections.begin_chunk(data, types["Extension"])
 
         if self.bone_data is not None:
-            data += self.bone_data.to_mem()
+            self.bone_data.to_mem(data)
 
         if self.user_data is not None:
-            data += self.user_data.to_mem()
+            self.user_data.to_mem(data)
 
         if self.name is not None and self.name != "unknown":
             frame_name = self.name.encode("utf-8")
             data += Sections.write_chunk(frame_name,
                                          types["Frame"])
 
-        return Sections.write_chunk(data, types["Extension"])
+        Sections.end_chunk(data, start)
+        return data
 
     ##################################################################
     def size():
@@ -762,9 +952,12 @@ class HAnimPLG:
 
         return self
     #######################################################
-    def to_mem(self):
+    def to_mem(self, data=None):
 
-        data = bytearray()
+        if data is None:
+            data = bytearray()
+
+        start = Sections.begin_chunk(data, types["HAnim PLG"])
 
         data += Sections.write(HAnimHeader, self.header)
         if len(self.bones) > 0:
@@ -773,7 +966,8 @@ class HAnimPLG:
         for bone in self.bones:
             data += Sections.write(Bone, bone)
 
-        return Sections.write_chunk(data, types["HAnim PLG"])
+        Sections.end_chunk(data, start)
+        return data
 
 #######################################################
 # TODO: AnimationPLG data
@@ -837,21 +1031,27 @@ class UVAnim:
         return self
 
     #######################################################
-    def to_mem(self):
+    def to_mem(self, data=None):
 
-        data = pack("<iiiif4x32s8I",
-                    0x100,
-                    self.type_id,
-                    len(self.frames),
-                    self.flags,
-                    self.duration,
-                    self.name.encode('ascii'),
-                    *self.node_to_uv)
+        if data is None:
+            data = bytearray()
+
+        start = Sections.begin_chunk(data, types["Animation Anim"])
+
+        data += pack("<iiiif4x32s8I",
+                     0x100,
+                     self.type_id,
+                     len(self.frames),
+                     self.flags,
+                     self.duration,
+                     self.name.encode('ascii'),
+                     *self.node_to_uv)
 
         for frame in self.frames:
             data += Sections.write(UVFrame, frame)
 
-        return Sections.write_chunk(data, types["Animation Anim"])
+        Sections.end_chunk(data, start)
+        return data
     
 #######################################################
 class SkinPLG:
@@ -900,7 +1100,7 @@ class SkinPLG:
         self.bones_used.sort()
 
     ##################################################################
-    def to_mem(self):
+    def to_mem(self, data=None):
 
         oldver = Sections.get_rw_version() < 0x34000
 
@@ -911,7 +1111,10 @@ class SkinPLG:
             self.max_weights_per_vertex = 0
             self.bones_used = []
 
-        data = bytearray()
+        if data is None:
+            data = bytearray()
+
+        start = Sections.begin_chunk(data, types["Skin PLG"])
         data += pack("<3Bx", self.num_bones, len(self.bones_used),
                      self.max_weights_per_vertex)
 
@@ -919,13 +1122,15 @@ class SkinPLG:
         if self.bones_used:
             data += pack(f"<{len(self.bones_used)}B", *self.bones_used)
 
+        vertices_count = len(self.vertex_bone_indices)
+
         # 4x Indices
-        for indices in self.vertex_bone_indices:
-            data += pack("<4B", *indices)
+        data += pack("<%dB" % (vertices_count * 4),
+                     *chain.from_iterable(self.vertex_bone_indices))
 
         # 4x Weight
-        for weight in self.vertex_bone_weights:
-            data += pack("<4f", *weight)
+        data += pack("<%df" % (len(self.vertex_bone_weights) * 4),
+                     *chain.from_iterable(self.vertex_bone_weights))
 
         # 4x4 Matrix
         for matrix in self.bone_matrices:
@@ -940,7 +1145,8 @@ class SkinPLG:
         if not oldver:
             data += pack("<12x")
 
-        return Sections.write_chunk(data, types["Skin PLG"])
+        Sections.end_chunk(data, start)
+        return data
 
     ##################################################################
     @staticmethod
@@ -1089,26 +1295,25 @@ class ExtraVertColorExtension:
 
         magic = unpack_from("<I", data, offset)[0]
         if magic != 0:
-            colors = []
-            for i in range(len(geometry.vertices)):
+            colors = PackedList.from_mem(
+                RGBA, data, offset + 4, len(geometry.vertices)
+            )
 
-                offset += 4
-                colors.append(
-                    Sections.read(
-                        RGBA, data, offset
-                    )
-                )
-                
             return ExtraVertColorExtension(colors)
                 
     #######################################################
-    def to_mem(self):
-        
-        data = pack("<I", 1)
-        for color in self.colors:
-            data += Sections.write(RGBA, color)
+    def to_mem(self, data=None):
+
+        if data is None:
+            data = bytearray()
 
-        return Sections.write_chunk(data, types["Extra Vert Color"])
+        start = Sections.begin_chunk(data, types["Extra Vert Color"])
+
+        data += pack("<I", 1)
+        data += Sections.write_array(RGBA, self.colors)
+
+        Sections.end_chunk(data, start)
+        return data
 
 #######################################################
 class Light2dfx:
@@ -1590,14 +1795,19 @@ class Extension2dfx:
         return self
 
     #######################################################
-    def to_mem(self):
+    def to_mem(self, data=None):
+
+        if data is None:
+            data = bytearray()
 
         # Write only if there are entries
         if self.is_empty():
-            return bytearray()
+            return data
+
+        start = Sections.begin_chunk(data, types['2d Effect'])
 
         # Entries length
-        data = pack("<I", len(self.entries))
+        data += pack("<I", len(self.entries))
 
         # Entries
         for entry in self.entries:
@@ -1608,7 +1818,8 @@ class Extension2dfx:
             data += pack("<II", entry.effect_id, len(entry_data))
             data += entry_data
 
-        return Sections.write_chunk(data, types['2d Effect'])
+        Sections.end_chunk(data, start)
+        return data
 
     #######################################################
     def __add__(self, other):
@@ -1689,12 +1900,12 @@ class ExtensionBreakable:
             pos += 2
 
         for _ in range(mats_num):
-            tex_name = data[pos:pos+strlen(data, pos)].decode("utf-8")
+            tex_name = bytes(data[pos:pos+strlen(data, pos)]).decode("utf-8")
             self.texture_names.append(tex_name)
             pos += 32
 
         for _ in range(mats_num):
-            tex_mask = data[pos:pos+strlen(data, pos)].decode("utf-8")
+            tex_mask = bytes(data[pos:pos+strlen(data, pos)]).decode("utf-8")
             self.texture_masks.append(tex_mask)
             pos += 32
 
@@ -1705,9 +1916,13 @@ class ExtensionBreakable:
         return self
 
     #######################################################
-    def to_mem(self):
+    def to_mem(self, data=None):
+
+        if data is None:
+            data = bytearray()
+
+        start = Sections.begin_chunk(data, types["Breakable Model"])
 
-        data = bytearray()
         data += pack("<I", self.magic)
 
         if self.magic != 0:
@@ -1745,7 +1960,8 @@ class ExtensionBreakable:
             for ac in self.ambient_colors:
                 data += Sections.write(Vector, ac)
 
-        return Sections.write_chunk(data, types["Breakable Model"])
+        Sections.end_chunk(data, start)
+        return data
 
 #######################################################
 class ExtensionColl:
@@ -1919,16 +2135,22 @@ class DeltaMorphPLG:
         return self
 
     #######################################################
-    def to_mem(self):
+    def to_mem(self, data=None):
+
+        if data is None:
+            data = bytearray()
 
         if not self.entries:
-            return bytearray()
+            return data
 
-        data = pack("<I", len(self.entries))
+        start = Sections.begin_chunk(data, types['Delta Morph PLG'])
+
+        data += pack("<I", len(self.entries))
         for entry in self.entries:
             data += entry.to_mem()
 
-        return Sections.write_chunk(data, types['Delta Morph PLG'])
+        Sections.end_chunk(data, start)
+        return data
 
     #######################################################
     def __add__(self, other):
@@ -1958,7 +2180,8 @@ class Geometry:
         '_num_triangles',
         '_num_vertices',
         '_vertex_bone_weights',
-        '_hasMatFX'
+        '_hasMatFX',
+        '_loader'
     ]
     
     ##################################################################
@@ -1994,15 +2217,44 @@ class Geometry:
         }
         self._hasMatFX = False
 
+        # used for lazy loading
+        self._loader = None
+
     #######################################################
     @staticmethod
-    def from_mem(data, parent_chunk):
+    def from_loader(loader):
+
+        # Creates a geometry without any of its slots set. The first access
+        # to any of them calls loader to decode the actual geometry.
+        self = Geometry.__new__(Geometry)
+        self._loader = loader
+
+        return self
+
+    #######################################################
+    def __getattr__(self, name):
+
+        # Only called for slots that haven't been set yet, which only
+        # happens for lazily loaded geometries that haven't been decoded
+        if name == '_loader' or self._loader is None:
+            raise AttributeError(name)
+
+        # The loader is only dropped once every slot is set, so a failed
+        # decode raises again on the next access instead of leaving an
+        # empty geometry behind
+        geometry = self._loader()
 
-        # Note: In the following function, I have used a loop
-        #      to load the texture coordinates or prelit colors,
-        #      although I feel that it might be more efficient to
-        #      convert an array to an array of namedtuples.
-        #      I have not found a way yet to implement such a function.
+        for slot in Geometry.__slots__:
+            if slot != '_loader':
+                setattr(self, slot, getattr(geometry, slot))
+
+        self._loader = None
+
+        return getattr(self, name)
+
+    #######################################################
+    @staticmethod
+    def from_mem(data, parent_chunk):
 
         self = Geometry()
         
@@ -2021,13 +2273,10 @@ class Geometry:
 
             # Read prelighting colors
             if self.flags & rpGEOMETRYPRELIT:
-                self.prelit_colors = []
-                
-                for i in range(self._num_vertices):
-                    prelit_color = Sections.read(RGBA, data, pos)
-                    self.prelit_colors.append(prelit_color)
-
-                    pos += 4
+                self.prelit_colors = PackedList.from_mem(
+                    RGBA, data, pos, self._num_vertices
+                )
+                pos += 4 * self._num_vertices
 
             # Read Texture Mapping coordinates
             if self.flags & (rpGEOMETRYTEXTURED | rpGEOMETRYTEXTURED2):
@@ -2038,21 +2287,18 @@ class Geometry:
 
                 self.uv_layers = []
                 for i in range(texCount):
-
-                    self.uv_layers.append([]) #add empty new layer
-                    
-                    for j in range(self._num_vertices):
-                        
-                        tex_coord = Sections.read(TexCoords, data, pos)
-                        self.uv_layers[i].append(tex_coord)
-                        pos += 8
+                    self.uv_layers.append(
+                        PackedList.from_mem(
+                            TexCoords, data, pos, self._num_vertices
+                        )
+                    )
+                    pos += 8 * self._num_vertices
 
             # Read Triangles
-            for i in range(self._num_triangles):
-                triangle = Sections.read(Triangle, data, pos)
-                self.triangles.append(triangle)
-                
-                pos += 8
+            self.triangles = PackedList.from_mem(
+                Triangle, data, pos, self._num_triangles
+            )
+            pos += 8 * self._num_triangles
 
         # Read  morph targets (This should be only once)
         self.bounding_sphere = Sections.read(Sphere, data, pos)
@@ -2064,42 +2310,47 @@ class Geometry:
 
         # read vertices
         if self.has_vertices:
-            for i in range(self._num_vertices):
-                vertice = Sections.read(Vector, data, pos)
-                self.vertices.append(vertice)
-                pos += 12
+            self.vertices = PackedList.from_mem(
+                Vector, data, pos, self._num_vertices
+            )
+            pos += 12 * self._num_vertices
             
         # read normals
         if self.has_normals:
-            for i in range(self._num_vertices):
-                normal = Sections.read(Vector, data, pos)
-                self.normals.append(normal)
-                pos += 12
+            self.normals = PackedList.from_mem(
+                Vector, data, pos, self._num_vertices
+            )
+            pos += 12 * self._num_vertices
 
         return self
 
     #######################################################
-    def material_list_to_mem(self):
+    def material_list_to_mem(self, data=None):
         # TODO: Support instance materials
 
-        data = bytearray()
-        
-        data += pack("<I", len(self.materials))
-        for i in range(len(self.materials)):
-            data += pack("<i", -1)
+        if data is None:
+            data = bytearray()
 
-        data = Sections.write_chunk(data, types["Struct"])
+        start = Sections.begin_chunk(data, types["Material List"])
+        
+        data += Sections.write_chunk(
+            pack("<I%di" % len(self.materials), len(self.materials),
+                 *([-1] * len(self.materials))),
+            types["Struct"]
+        )
 
         for material in self.materials:
-            data += material.to_mem()
+            material.to_mem(data)
             self._hasMatFX = material._hasMatFX if not self._hasMatFX else True
 
-        return Sections.write_chunk(data, types["Material List"])
+        Sections.end_chunk(data, start)
+        return data
 
     #######################################################
-    def write_bin_split(self):
+    def write_bin_split(self, data=None):
 
-        data = bytearray()
+        if data is None:
+            data = bytearray()
 
         meshes = defaultdict(list)
         is_tri_strip = self.export_flags["triangle_strip"]
@@ -2115,6 +2366,8 @@ class Geometry:
             for triangle in self.triangles:
                 meshes[triangle.material].extend([triangle.a, triangle.b, triangle.c])
 
+        start = Sections.begin_chunk(data, types["Bin Mesh PLG"])
+
         total_indices = sum(len(triangles) for triangles in meshes.values())
         data += pack("<III", int(is_tri_strip), len(meshes), total_indices)
 
@@ -2122,29 +2375,36 @@ class Geometry:
             data += pack("<II", len(meshes[mesh]), mesh)
             data += pack("<%dI" % (len(meshes[mesh])), *meshes[mesh])
 
-        return Sections.write_chunk(data, types["Bin Mesh PLG"])
+        Sections.end_chunk(data, start)
+        return data
     
     #######################################################
-    def extensions_to_mem(self, extra_extensions = []):
+    def extensions_to_mem(self, extra_extensions = [], data=None):
 
-        data = bytearray()
+        if data is None:
+            data = bytearray()
+
+        start = Sections.begin_chunk(data, types["Extension"])
 
         # Write Bin Mesh PLG
         if self.export_flags['write_mesh_plg'] or self.export_flags['exclude_geo_faces']:
-            data += self.write_bin_split()
+            self.write_bin_split(data)
         
         for extension in self.extensions:
-            if self.extensions[extension] is not None:
-                data += self.extensions[extension].to_mem()
+            if self.extensions[extension] is None:
+                continue
+
+            self.extensions[extension].to_mem(data)
 
         # Write extra extensions
         for extra_extension in extra_extensions:
-            data += extra_extension.to_mem()
+            extra_extension.to_mem(data)
             
-        return Sections.write_chunk(data, types["Extension"])
+        Sections.end_chunk(data, start)
+        return data
         
     #######################################################
-    def to_mem(self, extra_extensions = []):
+    def to_mem(self, extra_extensions = [], data=None):
 
         # Set flags
         flags = rpGEOMETRYPOSITIONS
@@ -2164,7 +2424,13 @@ class Geometry:
 
         flags |= (len(self.uv_layers) & 0xff) << 16
 
-        data = bytearray()
+        if data is None:
+            data = bytearray()
+
+        # Every chunk and stream below is written straight into data
+        geometry_start = Sections.begin_chunk(data, types["Geometry"])
+        struct_start = Sections.begin_chunk(data, types["Struct"])
+
         data += pack("<IIII",
                      flags,
                      len(self.triangles) if not self.export_flags["exclude_geo_faces"] else 0,
@@ -2177,18 +2443,15 @@ class Geometry:
 
         # Write pre-lit colors
         if flags & rpGEOMETRYPRELIT:
-            for color in self.prelit_colors:
-                data += Sections.write(RGBA, color)
+            data += Sections.write_array(RGBA, self.prelit_colors)
 
         # Write UV Layers
         for uv_layer in self.uv_layers:
-            for tex_coord in uv_layer:
-                data += Sections.write(TexCoords, tex_coord)
+            data += Sections.write_array(TexCoords, uv_layer)
 
         # Write Triangles
         if not self.export_flags["exclude_geo_faces"]:
-            for triangle in self.triangles:
-                data += Sections.write(Triangle, triangle)
+            data += Sections.write_array(Triangle, self.triangles)
 
         # Bounding sphere and has_vertices, has_normals
         data += Sections.write(Sphere, self.bounding_sphere)
@@ -2197,20 +2460,20 @@ class Geometry:
                      1 if flags & rpGEOMETRYNORMALS else 0)
 
         # Write Vertices
-        for vertex in self.vertices:
-            data += Sections.write(Vector, vertex)
+        data += Sections.write_array(Vector, self.vertices)
 
         # Write Normals
         if flags & rpGEOMETRYNORMALS:
-            for normal in self.normals:
-                data += Sections.write(Vector, normal)
+            data += Sections.write_array(Vector, self.normals)
 
-        data = Sections.write_chunk(data, types["Struct"])
+        Sections.end_chunk(data, struct_start)
         
         # Write Material List and extensions
-        data += self.material_list_to_mem()
-        data += self.extensions_to_mem(extra_extensions)
-        return Sections.write_chunk(data, types["Geometry"])
+        self.material_list_to_mem(data)
+        self.extensions_to_mem(extra_extensions, data)
+
+        Sections.end_chunk(data, geometry_start)
+        return data
 
 #######################################################
 
@@ -2229,9 +2492,19 @@ class dff:
 
         if offset is None:
             offset = self.pos
-        
+
+        # self.data is a memoryview, so this is a view and not a copy
         return self.data[offset:offset+size]
 
+    #######################################################
+    def raw_string(self, offset=None, encoding="utf-8"):
+
+        if offset is None:
+            offset = self.pos
+
+        size = strlen(self.data, offset)
+        return bytes(self.data[offset:offset+size]).decode(encoding)
+
     #######################################################
     def read_chunk(self):
         chunk = Sections.read(Chunk, self.data, self._read(12))
@@ -2270,7 +2543,7 @@ class dff:
                 animation_data = None
 
                 if chunk.type == types["Frame"]:
-                    name = self.raw(strlen(self.data,self.pos)).decode("utf-8")
+                    name = self.raw_string()
                     
                 elif chunk.type == types["HAnim PLG"]:
                     bone_data = HAnimPLG.from_mem(self.raw(chunk.size))
@@ -2300,13 +2573,45 @@ class dff:
             i += 1
             
 
+    #######################################################
+    @staticmethod
+    def mesh_plg_triangles(indices, material, is_tri_strip):
+
+        # Converts the index buffer of a single split into a flat array in
+        # the Triangle (b a material c) layout using only slice operations
+
+        if is_tri_strip:
+            count = max(len(indices) - 2, 0)
+
+            first  = indices[0:count]
+            second = indices[1:count+1]
+
+            # Every other triangle of a strip has the opposite winding
+            a, b = first[:], second[:]
+            a[1::2] = second[1::2]
+            b[1::2] = first[1::2]
+            c = indices[2:count+2]
+
+        else:
+            count = len(indices) // 3
+
+            a = indices[0:count*3:3]
+            b = indices[1:count*3:3]
+            c = indices[2:count*3:3]
+
+        triangles = array("H", bytes(8 * count))
+        triangles[0::4] = b
+        triangles[1::4] = a
+        triangles[2::4] = array("H", (material,)) * count
+        triangles[3::4] = c
+
+        return triangles
+
     #######################################################
     def read_mesh_plg(self, parent_chunk, geometry):
-        triangles = []
+        triangles = PackedList(Triangle)
         
         _Header      = namedtuple("_Header","flags mesh_count total_indices")
-        _SplitHeader = namedtuple("_SplitHeader","indices_count material")
-        _Triangle    = namedtuple("_Triangle", "a b c")
         
         header = _Header._make(unpack_from("<III", self.data, self._read(12)))
 
@@ -2323,9 +2628,9 @@ class dff:
         for i in range(header.mesh_count):
             
             # Read header
-            split_header = _SplitHeader._make(unpack_from("<II",
-                                                          self.data,
-                                                          self._read(8)))
+            split_header = SplitHeader._make(unpack_from("<II",
+                                                         self.data,
+                                                         self._read(8)))
 
             geometry.split_headers.append(split_header)
 
@@ -2334,69 +2639,27 @@ class dff:
                 if not has_indices:
                     continue
 
-            unpack_format = "<H" if opengl else "<H2x"
-            total_iterations = split_header.indices_count
-            
-            # Read 3 integers instead of 1 incase of triangle lists
-            if not is_tri_strip: 
-                unpack_format = "<" + (unpack_format[1:] * 3)
-                total_iterations //= 3
-
-            previous_vertices = []
-            for j in range(total_iterations):
+            # Read the whole index buffer of this split at once. 32 bit
+            # indices are read as pairs of 16 bit values, of which only the
+            # lower half is kept.
+            indices_count = split_header.indices_count
+            index_size = 2 if opengl else 4
 
-                # Read Triangle Strip
-                if is_tri_strip:
+            indices = array("H")
+            indices.frombytes(self.raw(indices_count * index_size,
+                                       self._read(indices_count * index_size)))
 
-                    vertex = unpack_from(
-                        unpack_format,
-                        self.data,
-                        self._read(2 if opengl else 4)
-                    )[0]
+            if byteorder != "little":
+                indices.byteswap()
 
-                    if len(previous_vertices) < 2:
-                        previous_vertices.append(vertex)
-                        continue
+            if not opengl:
+                indices = indices[0::2]
 
-                    if(j % 2 == 0):
-                        triangle = Triangle(
-                            previous_vertices[1],
-                            previous_vertices[0],
-                            split_header.material,
-                            vertex
-                        )
-                    else:
-                        triangle = Triangle(
-                            previous_vertices[0],
-                            previous_vertices[1],
-                            split_header.material,
-                            vertex
-                        )
-                
-                    previous_vertices[0] = previous_vertices[1]
-                    previous_vertices[1] = vertex
-
-                # Read Triangle List
-                else:
-
-                    _triangle = _Triangle._make(
-                        unpack_from(
-                            unpack_format,
-                            self.data,
-                            self._read(6 if opengl else 12)
-                        )
-                    )
-
-                    triangle = Triangle._make(
-                        (
-                            _triangle.b,
-                            _triangle.a,
-                            split_header.material,
-                            _triangle.c
-                        )
-                    )
-
-                triangles.append(triangle)
+            triangles.array.extend(
+                dff.mesh_plg_triangles(indices,
+                                       split_header.material,
+                                       is_tri_strip)
+            )
 
         geometry.extensions['mat_split'] = triangles
 
@@ -2560,23 +2823,19 @@ class dff:
         
         # Texture Name
         chunk = self.read_chunk()
-        texture.name = self.raw(
-            strlen(self.data,self.pos)
-        ).decode("utf-8")
+        texture.name = self.raw_string()
         
         self._read(chunk.size)
         
         # Mask Name
         chunk = self.read_chunk()  
-        texture.mask = self.raw(
-            strlen(self.data,self.pos)
-        ).decode("utf-8")
+        texture.mask = self.raw_string()
         
         self._read(chunk.size)
         return texture
         
     #######################################################
-    def read_material_list(self, parent_chunk):
+    def read_material_list(self, parent_chunk, geometry):
         list_end = parent_chunk.size + self.pos
         chunk = self.read_chunk()
 
@@ -2668,18 +2927,17 @@ class dff:
                                         # Read n animations
                                         for i in range(anim_count):
                                             material.add_plugin('uv_anim',
-                                                                self.raw(
-                                                                    strlen(
-                                                                        self.data,
-                                                                        self.pos
-                                                                    ),
-                                                                    self._read(32)
-                                                                ).decode('ascii')
+                                                                self.raw_string(
+                                                                    offset=self._read(32),
+                                                                    encoding='ascii'
+                                                                )
                                             )
 
                                     if chunk.type == types["NTL Material Extension"]:
                                         # TODO: Have no idea how to read this extension, so fill it with zeros
-                                        self.data = self.data[:self.pos] + (b'\0' * chunk.size) + self.data[self.pos:]
+                                        self.data = memoryview(
+                                            bytes(self.data[:self.pos]) + (b'\0' * chunk.size) + self.data[self.pos:]
+                                        )
 
                                     self.pos = __chunk_end
                                     
@@ -2689,7 +2947,7 @@ class dff:
                         else:
                             self._read(chunk.size)
 
-                    self.geometry_list[-1].materials.append(material)
+                    geometry.materials.append(material)
                     
                 self.pos = chunk_end
 
@@ -2712,6 +2970,57 @@ class dff:
     #######################################################
     def read_geometry(self, parent_chunk):
 
+        if self.lazy:
+            geometry = self.read_lazy_geometry(parent_chunk)
+        else:
+            geometry = self.decode_geometry(parent_chunk)
+
+        self.geometry_list.append(geometry)
+
+    #######################################################
+    def read_lazy_geometry(self, parent_chunk):
+
+        from .toc import toc
+
+        chunk_end = self.pos + parent_chunk.size
+
+        # Reading an NTL Material Extension inserts zeros into the data,
+        # which the chunks after it rely on, so such geometries are decoded
+        # right away
+        index = toc()
+        index.load_memory(self.data, self.pos, chunk_end)
+        if types["NTL Material Extension"] in index:
+            return self.decode_geometry(parent_chunk)
+
+        def loader(pos=self.pos):
+            current_pos, current_data = self.pos, self.data
+
+            try:
+                self.pos = pos
+                return self.decode_geometry(parent_chunk, False)
+            finally:
+                self.pos, self.data = current_pos, current_data
+
+        # 2dfx belongs to the whole clump, so it is read right away
+        while self.pos < chunk_end:
+            chunk = self.read_chunk()
+
+            if chunk.type == types["2d Effect"]:
+                self.ext_2dfx += Extension2dfx.from_mem(
+                    self.data,
+                    self._read(chunk.size)
+                )
+
+            # Extension only contains other chunks
+            elif chunk.type != types["Extension"]:
+                self._read(chunk.size)
+
+        self.pos = chunk_end
+        return Geometry.from_loader(loader)
+
+    #######################################################
+    def decode_geometry(self, parent_chunk, read_2dfx=True):
+
         chunk_end = self.pos + parent_chunk.size
 
         chunk = self.read_chunk()
@@ -2719,14 +3028,12 @@ class dff:
 
         self._read(chunk.size)
 
-        self.geometry_list.append(geometry)
-
         while self.pos < chunk_end:
 
             chunk = self.read_chunk()
 
             if chunk.type == types["Material List"]:
-                self.read_material_list(chunk)
+                self.read_material_list(chunk, geometry)
 
             elif chunk.type == types["Extension"]:
                 pass
@@ -2764,7 +3071,7 @@ class dff:
                 )
 
             # 2dfx (usually at the last geometry index)
-            elif chunk.type == types["2d Effect"]:
+            elif chunk.type == types["2d Effect"] and read_2dfx:
                 self.ext_2dfx += Extension2dfx.from_mem(
                     self.data,
                     self._read(chunk.size)
@@ -2783,6 +3090,7 @@ class dff:
                 self._read(chunk.size)
 
         self.pos = chunk_end
+        return geometry
 
     #######################################################
     def read_atomic(self, parent_chunk):
@@ -2825,7 +3133,18 @@ class dff:
                         geometry = self.geometry_list[atomic.geometry]
 
                         skin = SkinPLG.from_mem(self.data[self.pos:], geometry, frame)
-                        geometry.extensions["skin"] = skin
+
+                        # Attaching the skin would decode a lazy geometry,
+                        # so its loader does it instead
+                        if geometry._loader is not None:
+                            def loader(decode=geometry._loader, skin=skin):
+                                geometry = decode()
+                                geometry.extensions["skin"] = skin
+                                return geometry
+
+                            geometry._loader = loader
+                        else:
+                            geometry.extensions["skin"] = skin
 
                         bone_frames = self.frame_list[atomic.frame + 1:]
                         for bone in frame.bone_data.bones[1:]:
@@ -2892,7 +3211,7 @@ class dff:
 
                 elif chunk.type in (types["Collision Model"], types["SAMP Collision Model"]):
                     self.collisions.append(
-                        ExtensionColl(chunk.type, self.data[self.pos:self.pos + chunk.size])
+                        ExtensionColl(chunk.type, bytes(self.raw(chunk.size)))
                     )
                     self.pos += chunk.size
                     
@@ -2923,9 +3242,15 @@ class dff:
             self._read(chunk.size)
             
     #######################################################
-    def load_memory(self, data):
+    def load_memory(self, data, lazy=False):
 
-        self.data = data
+        # Geometries are only decoded once they are accessed in lazy mode,
+        # which is useful when only frames, atomics or collisions are needed
+        self.lazy = lazy
+
+        # Work on a single memoryview of the file, so all the sections below
+        # get views into it instead of copies of the remaining data
+        self.data = memoryview(data)
         while self.pos < len(data) - 12:
             chunk = self.read_chunk()
 
@@ -2940,6 +3265,57 @@ class dff:
                 self.read_atomic(chunk)
                 self.rw_version = Sections.get_rw_version(chunk.version)
 
+    #######################################################
+    def seek_chunk(self, entry):
+
+        # Jumps to a chunk from a gtaLib.toc index and reads its header
+        self.pos = entry.offset
+        return self.read_chunk()
+
+    #######################################################
+    def load_toc(self, data, index):
+
+        # Reads the first clump using a gtaLib.toc index of the data instead
+        # of walking the chunks. Geometries are loaded lazily.
+        self.data = memoryview(data)
+        self.lazy = True
+
+        for entry in index.find_all(types["UV Animation Dictionary"], -1):
+            self.seek_chunk(entry)
+            self.read_uv_anim_dict()
+
+        clump_idx = index.find(types["Clump"])
+        if clump_idx < 0:
+            return
+
+        self.rw_version = index.entries[clump_idx].rw_version
+
+        # Collisions are stored in the clump extension
+        entries = []
+        for entry in index:
+            if entry.parent == clump_idx:
+                entries.append(entry)
+            elif entry.parent >= 0:
+                parent = index.entries[entry.parent]
+                if parent.type == types["Extension"] and parent.parent == clump_idx:
+                    entries.append(entry)
+
+        for entry in entries:
+
+            if entry.type == types["Frame List"]:
+                self.read_frame_list(self.seek_chunk(entry))
+
+            elif entry.type == types["Geometry List"]:
+                self.read_geometry_list(self.seek_chunk(entry))
+
+            elif entry.type == types["Atomic"]:
+                self.read_atomic(self.seek_chunk(entry))
+
+            elif entry.type in (types["Collision Model"], types["SAMP Collision Model"]):
+                self.collisions.append(
+                    ExtensionColl(entry.type, bytes(self.data[entry.data_offset:entry.end]))
+                )
+
     #######################################################
     def clear(self):
         self.frame_list    = []
@@ -2952,37 +3328,39 @@ class dff:
         self.pos           = 0
         self.data          = ""
         self.rw_version    = ""
+        self.lazy          = False
             
     #######################################################
-    def load_file(self, filename):
+    def load_file(self, filename, lazy=False):
 
         with open(filename, mode='rb') as file:
             content = file.read()
-            self.load_memory(content)
+            self.load_memory(content, lazy)
            
     #######################################################
-    def write_frame_list(self):
+    def write_frame_list(self, data):
 
-        data = bytearray()
+        start = Sections.begin_chunk(data, types["Frame List"])
+        struct_start = Sections.begin_chunk(data, types["Struct"])
 
         data += pack("<I", len(self.frame_list)) # length
 
         for frame in self.frame_list:
             data += frame.header_to_mem()
 
-        data = Sections.write_chunk(data, types["Struct"])
+        Sections.end_chunk(data, struct_start)
         
         for frame in self.frame_list:
-            data += frame.extensions_to_mem()
+            frame.extensions_to_mem(data)
 
-        return Sections.write_chunk(data, types["Frame List"])
+        Sections.end_chunk(data, start)
 
     #######################################################
-    def write_geometry_list(self):
-        data = bytearray()
-        data += pack("<I", len(self.geometry_list))
+    def write_geometry_list(self, data):
 
-        data = Sections.write_chunk(data, types["Struct"])
+        start = Sections.begin_chunk(data, types["Geometry List"])
+        data += Sections.write_chunk(pack("<I", len(self.geometry_list)),
+                                     types["Struct"])
         
         for index, geometry in enumerate(self.geometry_list):
 
@@ -2991,80 +3369,83 @@ class dff:
             if index == len(self.geometry_list) - 1 and not self.ext_2dfx.is_empty():
                 extra_extensions.append(self.ext_2dfx)
             
-            data += geometry.to_mem(extra_extensions)
+            geometry.to_mem(extra_extensions, data)
         
-        return Sections.write_chunk(data, types["Geometry List"])
+        Sections.end_chunk(data, start)
 
     #######################################################
-    def write_atomic(self, atomic):
+    def write_atomic(self, atomic, data):
 
-        data = atomic.to_mem()
-        data = Sections.write_chunk(data, types["Struct"])
+        start = Sections.begin_chunk(data, types["Atomic"])
+        data += Sections.write_chunk(atomic.to_mem(), types["Struct"])
         geometry = self.geometry_list[atomic.geometry]
 
-        ext_data = bytearray()
+        ext_start = Sections.begin_chunk(data, types["Extension"])
         if "skin" in geometry.extensions:
             right_to_render = atomic.extensions.get("right_to_render")
             if not right_to_render:
                 right_to_render = RightToRender._make((0x0116, 1))
-            ext_data += Sections.write_chunk(
+            data += Sections.write_chunk(
                 pack("<II", right_to_render.value1, right_to_render.value2),
                 types["Right to Render"]
             )
 
         if geometry._hasMatFX:
-            ext_data += Sections.write_chunk(
+            data += Sections.write_chunk(
                 pack("<I", 1),
                 types["Material Effects PLG"]
             )
 
         pipeline = atomic.extensions.get("pipeline")
         if pipeline is not None:
-            ext_data += Sections.write_chunk(
+            data += Sections.write_chunk(
                 pack("<I", pipeline),
                 types["Pipeline Set"]
             )
 
         sky_gfx = atomic.extensions.get("sky_gfx")
         if sky_gfx is not None:
-            ext_data += Sections.write_chunk(
+            data += Sections.write_chunk(
                 pack("<B", sky_gfx),
                 types["SkyGFX"]
             )
 
-        data += Sections.write_chunk(ext_data, types["Extension"])
-        return Sections.write_chunk(data, types["Atomic"])
+        Sections.end_chunk(data, ext_start)
+        Sections.end_chunk(data, start)
 
     #######################################################
-    def write_uv_dict(self):
+    def write_uv_dict(self, data):
 
         if len(self.uvanim_dict) < 1:
-            return bytearray()
+            return
         
-        data = pack("<I", len(self.uvanim_dict))
-        data = Sections.write_chunk(data, types["Struct"])
+        start = Sections.begin_chunk(data, types["UV Animation Dictionary"])
+        data += Sections.write_chunk(pack("<I", len(self.uvanim_dict)),
+                                     types["Struct"])
         
         for dictionary in self.uvanim_dict:
-            data += dictionary.to_mem()
+            dictionary.to_mem(data)
 
-        return Sections.write_chunk(data, types["UV Animation Dictionary"])
+        Sections.end_chunk(data, start)
 
     #######################################################
-    def write_clump(self):
+    def write_clump(self, data):
 
-        data = Sections.write(Clump, (len(self.atomic_list), 0,0), types["Struct"])
+        start = Sections.begin_chunk(data, types["Clump"])
 
         # Old RW versions didn't have cameras and lights in their clump structure
         if Sections.get_rw_version() < 0x33000:
-            data = Sections.write_chunk(pack("<I",
-                                             len(self.atomic_list)),
-                                        types["Struct"])
+            data += Sections.write_chunk(pack("<I",
+                                              len(self.atomic_list)),
+                                         types["Struct"])
+        else:
+            data += Sections.write(Clump, (len(self.atomic_list), 0,0), types["Struct"])
             
-        data += self.write_frame_list()
-        data += self.write_geometry_list()
+        self.write_frame_list(data)
+        self.write_geometry_list(data)
 
         for atomic in self.atomic_list:
-            data += self.write_atomic(atomic)
+            self.write_atomic(atomic, data)
 
         for coll in self.collisions:
             _data = Sections.write_chunk(coll.data, coll.ext_type)
@@ -3072,16 +3453,17 @@ class dff:
             
         data += Sections.write_chunk(bytearray(), types["Extension"])
             
-        return Sections.write_chunk(data, types["Clump"])
+        Sections.end_chunk(data, start)
     
     #######################################################
     def write_memory(self, version):
 
         data = bytearray()
-        Sections.set_library_id(version, 0xFFFF)
 
-        data += self.write_uv_dict()
-        data += self.write_clump()
+        # The whole file is written into this one buffer
+        with WriterContext(version):
+            self.write_uv_dict(data)
+            self.write_clump(data)
 
         return data
             
@@ -14,10 +14,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import mmap
 import os
 
 from dataclasses import dataclass
-from struct import unpack, unpack_from
+from struct import pack, unpack_from
+
+SECTOR_SIZE = 2048
+
+#######################################################
+def sectors_count(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
 
 #######################################################
 @dataclass
@@ -33,6 +40,10 @@ class DirectoryEntry:
         name = name.split(b'\0', 1)[0].decode('utf-8')
         return cls(offset, size, name)
 
+    #######################################################
+    def to_mem(self):
+        return pack("II24s", self.offset, self.size, self.name.encode('utf-8'))
+
 #######################################################
 class img:
 
@@ -41,37 +52,267 @@ class img:
         data_len = len(data)
         for pos in range(0, data_len, 32):
             entry = DirectoryEntry.read_from_memory(data, pos)
+            self._index_entry(len(self.directory_entries), entry)
             self.directory_entries.append(entry)
 
+    #######################################################
+    def _index_entry(self, entry_idx, entry):
+
+        # Names are case insensitive, the first entry with a name wins
+        name = entry.name.lower()
+        self.name_index.setdefault(name, entry_idx)
+
+        extension = os.path.splitext(name)[1]
+        self.extension_index.setdefault(extension, []).append(entry_idx)
+
     #######################################################
     def clear(self):
         self.directory_entries:list[DirectoryEntry] = []
+        self.name_index:dict[str, int] = {}
+        self.extension_index:dict[str, list[int]] = {}
         self.entry_idx = 0
 
     #######################################################
     @classmethod
-    def open(cls, filename):
-        file = open(filename, mode='rb')
+    def open(cls, filename, use_mmap=False, writable=False):
+        file = open(filename, mode='r+b' if writable else 'rb')
         self = cls(file)
+        self.filename = filename
+        self.writable = writable
 
-        magic, entries_num = unpack("4sI", file.read(8))
-
-        if magic == b"VER2":
-            dir_data = file.read(entries_num * 32)
-            self.load_dir_memory(dir_data)
+        try:
+            header = file.read(8)
 
-        else:
-            dir_filename = os.path.splitext(filename)[0] + '.dir'
-            with open(dir_filename, mode='rb') as dir_file:
-                dir_data = dir_file.read()
+            if header[:4] == b"VER2":
+                entries_num = unpack_from("I", header, 4)[0]
+                self.version = 2
+                dir_data = file.read(entries_num * 32)
                 self.load_dir_memory(dir_data)
 
+            else:
+                self.version = 1
+                self.dir_filename = os.path.splitext(filename)[0] + '.dir'
+                with open(self.dir_filename, mode='rb') as dir_file:
+                    dir_data = dir_file.read()
+                    self.load_dir_memory(dir_data)
+
+        except Exception:
+            file.close()
+            raise
+
         file.seek(0, os.SEEK_SET)
 
+        # Entries are then read as memoryview slices of the mapped file. The
+        # mapping has a fixed size, so it isn't used when writing.
+        if use_mmap and not writable and os.fstat(file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+
+        return self
+
+    #######################################################
+    @classmethod
+    def create(cls, filename, version=2):
+
+        # New empty archive, open for writing. Version 1 archives keep their
+        # directory in a .dir file next to the .img.
+        file = open(filename, mode='w+b')
+        self = cls(file)
+        self.filename = filename
+        self.writable = True
+        self.version = version
+
+        if version == 1:
+            self.dir_filename = os.path.splitext(filename)[0] + '.dir'
+
+        self._dirty = True
+        self.flush()
+
         return self
 
+    #######################################################
+    def _end_sector(self):
+
+        # First sector after all the entry data, cached between writes
+        if self._end is None:
+            self._end = max(
+                (entry.offset + entry.size for entry in self.directory_entries), default=0
+            )
+        return max(self._end, self._first_sector(len(self.directory_entries)))
+
+    #######################################################
+    def _first_sector(self, entries_num):
+
+        # First sector available to entry data
+        if self.version == 2:
+            return sectors_count(8 + entries_num * 32)
+        return 0
+
+    #######################################################
+    def _write_sectors(self, sector, data):
+        self._file.seek(sector * SECTOR_SIZE, os.SEEK_SET)
+        self._file.write(data)
+
+        padding = -len(data) % SECTOR_SIZE
+        if padding:
+            self._file.write(b'\0' * padding)
+
+    #######################################################
+    def _move_entry(self, entry, sector):
+        self._file.seek(entry.offset * SECTOR_SIZE, os.SEEK_SET)
+        data = self._file.read(entry.size * SECTOR_SIZE)
+
+        self._write_sectors(sector, data)
+        entry.offset = sector
+        self._end = max(self._end_sector(), sector + entry.size)
+
+    #######################################################
+    def _reserve_directory(self, entries_num):
+
+        # The VER2 directory sits in front of the entry data. Entries that
+        # would be overwritten by a grown directory are moved to the end.
+        first_sector = self._first_sector(entries_num)
+        for entry in sorted(self.directory_entries, key=lambda entry: entry.offset):
+            if entry.offset >= first_sector:
+                break
+            self._move_entry(entry, max(self._end_sector(), first_sector))
+
+    #######################################################
+    def write_entry(self, name, data):
+
+        # Adds an entry or replaces the entry with the same name. The data
+        # is written in place when it fits the sectors of the old entry and
+        # appended at the end of the archive otherwise. The directory is
+        # written on flush() or close().
+        self._check_writable()
+
+        if len(name.encode('utf-8')) > 23:
+            raise ValueError("IMG entry name too long", name)
+
+        sectors = sectors_count(len(data))
+        entry_idx = self.find_entry_idx(name)
+
+        if entry_idx > -1:
+            entry = self.directory_entries[entry_idx]
+
+            # The last entry can grow in place
+            if sectors > entry.size and entry.offset + entry.size < self._end_sector():
+                entry.offset = self._end_sector()
+
+        else:
+            self._reserve_directory(len(self.directory_entries) + 1)
+
+            entry = DirectoryEntry(self._end_sector(), 0, name)
+            self._index_entry(len(self.directory_entries), entry)
+            self.directory_entries.append(entry)
+
+        self._write_sectors(entry.offset, data)
+        entry.size = sectors
+        self._end = max(self._end_sector(), entry.offset + sectors)
+        self._dirty = True
+
+        return entry
+
+    #######################################################
+    def _check_writable(self):
+        if not self.writable:
+            raise ValueError("IMG archive not opened for writing", self.filename)
+
+    #######################################################
+    def _directory_to_mem(self, entries):
+        return b''.join(entry.to_mem() for entry in entries)
+
+    #######################################################
+    def flush(self):
+        if not self._dirty:
+            return
+
+        if self.version == 2:
+            self._file.seek(0, os.SEEK_SET)
+            self._file.write(pack("4sI", b"VER2", len(self.directory_entries)))
+            self._file.write(self._directory_to_mem(self.directory_entries))
+
+            # Keep the file a whole number of sectors
+            self._file.seek(0, os.SEEK_END)
+            if self._file.tell() < self._end_sector() * SECTOR_SIZE:
+                self._file.truncate(self._end_sector() * SECTOR_SIZE)
+
+        else:
+            with open(self.dir_filename, mode='wb') as dir_file:
+                dir_file.write(self._directory_to_mem(self.directory_entries))
+
+        self._file.flush()
+        self._dirty = False
+
+    #######################################################
+    def compact(self):
+
+        # Rewrites the archive with the entries sorted by name and their data
+        # contiguous, dropping the space left by replaced entries. The new
+        # archive and its directory are written completely next to the old
+        # ones and then moved over them.
+        self._check_writable()
+        self.flush()
+
+        entries = sorted(self.directory_entries, key=lambda entry: entry.name.lower())
+        new_entries = []
+
+        sector = self._first_sector(len(entries))
+        for entry in entries:
+            new_entries.append(DirectoryEntry(sector, entry.size, entry.name))
+            sector += entry.size
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, mode='wb') as tmp_file:
+            if self.version == 2:
+                tmp_file.write(pack("4sI", b"VER2", len(new_entries)))
+                tmp_file.write(self._directory_to_mem(new_entries))
+
+            for entry, new_entry in zip(entries, new_entries):
+                self._file.seek(entry.offset * SECTOR_SIZE, os.SEEK_SET)
+                data = self._file.read(entry.size * SECTOR_SIZE)
+
+                tmp_file.seek(new_entry.offset * SECTOR_SIZE, os.SEEK_SET)
+                tmp_file.write(data.ljust(entry.size * SECTOR_SIZE, b'\0'))
+
+            tmp_file.truncate(sector * SECTOR_SIZE)
+
+        if self.version == 1:
+            tmp_dir_filename = self.dir_filename + '.tmp'
+            with open(tmp_dir_filename, mode='wb') as tmp_dir_file:
+                tmp_dir_file.write(self._directory_to_mem(new_entries))
+
+        self._file.close()
+        os.replace(tmp_filename, self.filename)
+        if self.version == 1:
+            os.replace(tmp_dir_filename, self.dir_filename)
+
+        self._file = open(self.filename, mode='r+b')
+
+        self.clear()
+        self._end = None
+        for entry in new_entries:
+            self._index_entry(len(self.directory_entries), entry)
+            self.directory_entries.append(entry)
+
     #######################################################
     def close(self):
+        if self._file and not self._file.closed and self._dirty:
+            self.flush()
+
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+
+        if self._mmap is not None:
+            # Slices of the mapping may still be in use, it is then unmapped
+            # when the last of them is released
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+
         if self._file and not self._file.closed:
             self._file.close()
 
@@ -82,23 +323,164 @@ class img:
 
         if 0 <= entry_idx < len(self.directory_entries):
             entry = self.directory_entries[entry_idx]
-            self._file.seek(entry.offset * 2048, os.SEEK_SET)
+            offset = entry.offset * 2048
+
+            if self._view is not None:
+                return entry.name, self._view[offset:offset + entry.size * 2048]
+
+            self._file.seek(offset, os.SEEK_SET)
             return entry.name, self._file.read(entry.size * 2048)
 
         return "", b""
 
+    #######################################################
+    def _read_runs(self, positions, indices, max_read_size):
+
+        # Groups the requests, sorted by offset, into runs of adjacent or
+        # overlapping sectors. Yields (first sector, data, positions).
+        entries = self.directory_entries
+        max_sectors = max(max_read_size // SECTOR_SIZE, 1)
+
+        run, run_start, run_end = [], 0, 0
+        for pos in positions + [None]:
+            if pos is not None:
+                entry = entries[indices[pos]]
+                end = max(run_end, entry.offset + entry.size)
+                if run and entry.offset <= run_end and end - run_start <= max_sectors:
+                    run.append(pos)
+                    run_end = end
+                    continue
+
+            if run:
+                offset = run_start * SECTOR_SIZE
+                size = (run_end - run_start) * SECTOR_SIZE
+
+                if self._view is not None:
+                    data = self._view[offset:offset + size]
+                else:
+                    self._file.seek(offset, os.SEEK_SET)
+                    data = self._file.read(size)
+
+                yield run_start, data, run
+
+            if pos is not None:
+                run, run_start, run_end = [pos], entry.offset, entry.offset + entry.size
+
+    #######################################################
+    def _request_windows(self, indices, max_read_size):
+
+        # Splits the requests, in request order, into ranges holding about
+        # max_read_size bytes of entries each
+        entries = self.directory_entries
+
+        start, size = 0, 0
+        for pos, entry_idx in enumerate(indices):
+            if 0 <= entry_idx < len(entries):
+                size += entries[entry_idx].size * SECTOR_SIZE
+
+            if size >= max_read_size:
+                yield range(start, pos + 1)
+                start, size = pos + 1, 0
+
+        if start < len(indices):
+            yield range(start, len(indices))
+
+    #######################################################
+    def read_entries(self, indices=None, disk_order=False, max_read_size=16 << 20):
+
+        # Reads many entries with a few large sequential reads instead of a
+        # seek per entry: requests are sorted by offset and adjacent entries
+        # are read together, up to max_read_size bytes per read. Yields
+        # (name, data) like read_entry(), in disk order or in the order of
+        # indices (all of them by default). Invalid indices yield ("", b""),
+        # last in disk order.
+        #
+        # In request order, entries read ahead of their turn are kept until
+        # then. To bound that, the requests are sorted and read in windows of
+        # about max_read_size bytes. Mapped archives only keep views, and are
+        # sorted as a whole.
+        entries = self.directory_entries
+        if indices is None:
+            indices = range(len(entries))
+        indices = list(indices)
+
+        if disk_order or self._view is not None:
+            windows = [range(len(indices))]
+        else:
+            windows = self._request_windows(indices, max_read_size)
+
+        for window in windows:
+            valid = [pos for pos in window if 0 <= indices[pos] < len(entries)]
+            valid.sort(key=lambda pos: entries[indices[pos]].offset)
+
+            results = {}
+            next_pos = window.start
+
+            for run_start, data, run in self._read_runs(valid, indices, max_read_size):
+                for pos in run:
+                    entry = entries[indices[pos]]
+                    start = (entry.offset - run_start) * SECTOR_SIZE
+                    result = entry.name, data[start:start + entry.size * SECTOR_SIZE]
+
+                    if disk_order:
+                        yield result
+                    else:
+                        results[pos] = result
+
+                while next_pos < window.stop and not disk_order:
+                    if next_pos in results:
+                        yield results.pop(next_pos)
+                    elif not 0 <= indices[next_pos] < len(entries):
+                        yield "", b""
+                    else:
+                        break
+                    next_pos += 1
+
+            # Invalid indices after the last entry read
+            if disk_order:
+                invalid_num = len(window) - len(valid)
+            else:
+                invalid_num = window.stop - next_pos
+
+            for _ in range(invalid_num):
+                yield "", b""
+
     #######################################################
     def find_entry_idx(self, name):
-        return next(
-            (idx for idx, entry in enumerate(self.directory_entries) if entry.name == name),
-            -1
-        )
+        return self.name_index.get(name.lower(), -1)
+
+    #######################################################
+    def find_entry(self, name):
+        entry_idx = self.name_index.get(name.lower(), -1)
+        return self.directory_entries[entry_idx] if entry_idx > -1 else None
+
+    #######################################################
+    def find_entries(self, names):
+        name_index = self.name_index
+        return [name_index.get(name.lower(), -1) for name in names]
+
+    #######################################################
+    def find_entries_by_extension(self, extension):
+        # extension with the dot, e.g. ".dff"
+        return self.extension_index.get(extension.lower(), [])
 
     #######################################################
     def __init__(self, file):
         self._file = file
+        self._mmap = None
+        self._view = None
+        self._dirty = False
+        self._end = None
+        self.writable = False
+        self.filename = None
+        self.dir_filename = None
+        self.version = 2
         self.clear()
 
+    #######################################################
+    def __contains__(self, name):
+        return name.lower() in self.name_index
+
     #######################################################
     def __enter__(self):
         return self
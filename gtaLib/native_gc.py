@@ -18,7 +18,8 @@ from struct import unpack_from, calcsize
 from collections import namedtuple
 
 from .dff import RGBA, Sections, TexCoords, Triangle, Vector
-from .txd import ImageDecoder, TextureNative, PaletteType
+from .txd import ImageDecoder, MipLevels, TextureNative, PaletteType, numpy
+from . import swizzle
 
 # geometry flags
 rpGEOMETRYTRISTRIP              = 0x00000001
@@ -491,19 +492,21 @@ class NativeGCTexture(TextureNative):
 
         is_swizzled = NativeGCTexture.is_swizzled_texture(self.texture_format)
 
-        self.pixels = []
+        self.pixels = MipLevels(data, self.unswizzle_level if is_swizzled else None)
         for i in range(self.num_levels):
             width, height = self.get_width(i), self.get_height(i)
             data_len = NativeGCTexture.get_texture_format_len(width, height, self.texture_format)
-            pixels = self._read_raw(data_len)
-            if is_swizzled:
-                pixels = NativeGCTexture.unswizzle(pixels, width, height, self.texture_format)
-            self.pixels.append(pixels)
+            self.pixels.add(self._read(data_len), data_len)
 
         self.pos = end_pos
 
         return self
 
+    #######################################################
+    def unswizzle_level(self, pixels, level):
+        width, height = self.get_width(level), self.get_height(level)
+        return NativeGCTexture.unswizzle(pixels, width, height, self.texture_format)
+
     #######################################################
     @staticmethod
     def is_swizzled_texture(texture_format):
@@ -544,18 +547,8 @@ class NativeGCTexture(TextureNative):
         bpp, bw, bh = NativeGCTexture.get_texture_block_attributes(texture_format)
         aligned_width  = NativeGCTexture.get_aligned_len(width, bw)
         aligned_height = NativeGCTexture.get_aligned_len(height, bh)
-        strip_size = bpp * bw // 8
-
-        res = bytearray(aligned_width * aligned_height * bpp // 8)
-        pos = 0
-
-        for y in range(0, aligned_height, bh):
-            for x in range(0, aligned_width, bw):
-                for y2 in range(bh):
-                    idx = (((y + y2) * aligned_width) + x) * bpp // 8
-                    res[idx : idx+strip_size] = data[pos : pos+strip_size]
-                    pos += strip_size
 
+        res = swizzle.unswizzle(data, "gc", aligned_width, aligned_height, bpp)
         return NativeGCTexture.crop(res, aligned_width, aligned_height, bpp, width, height)
 
     #######################################################
@@ -564,6 +557,12 @@ class NativeGCTexture(TextureNative):
         if width == new_width and height == new_height:
             return data
 
+        # Single copy of the kept rows and columns
+        if numpy is not None and new_width <= width and new_height <= height:
+            row_len = width * bpp // 8
+            rows = numpy.frombuffer(data, numpy.uint8, row_len * height).reshape(height, row_len)
+            return rows[:new_height, :new_width * bpp // 8].tobytes()
+
         res = bytearray(new_width * new_height * bpp // 8)
         lw = min(width, new_width) * bpp // 8
 
@@ -577,6 +576,25 @@ class NativeGCTexture(TextureNative):
     #######################################################
     @staticmethod
     def decode_bc1(data, width, height):
+
+        # Big endian BC1 blocks, grouped in 8x8 tiles of 2x2 blocks
+        if numpy is not None:
+            tiles_x, tiles_y = (width + 7) // 8, (height + 7) // 8
+            blocks = numpy.frombuffer(
+                data,
+                numpy.dtype([('c0', '>u2'), ('c1', '>u2'), ('bits', '>u4')]),
+                tiles_x * tiles_y * 4
+            )
+            rgba = ImageDecoder._bc_colors(
+                blocks['c0'], blocks['c1'],
+                ImageDecoder._bc_indices(blocks['bits'], 16, (30, -2)),
+                0x00
+            )
+            rgba = rgba.reshape(tiles_y, tiles_x, 2, 2, 16, 4).transpose(0, 2, 1, 3, 4, 5)
+            return ImageDecoder._blocks_to_image(rgba.reshape(-1, 16, 4),
+                                                 tiles_x * 2, tiles_y * 2,
+                                                 width, height)
+
         pos = 0
         ret = bytearray(4 * width * height)
 
@@ -741,4 +759,4 @@ class NativeGCTexture(TextureNative):
     #######################################################
     def _read_raw(self, size):
         offset = self._read(size)
-        return self.data[offset:offset+size]
+        return bytes(self.data[offset:offset+size])
@@ -14,11 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from functools import lru_cache
+from operator import or_
 from struct import unpack_from, calcsize, pack
 
 from .dff import Chunk, RGBA, Sections, TexCoords, Triangle, Vector
 from .dff import ExtraVertColorExtension
-from .txd import TextureNative, RasterFormat, PaletteType
+from .txd import MipLevels, TextureNative, RasterFormat, PaletteType, numpy
+from . import swizzle
 
 # geometry flags
 rpGEOMETRYTRISTRIP              = 0x00000001
@@ -454,7 +457,8 @@ class NativePS2Texture(TextureNative):
                 palette_size -= 80
 
                 self._read(80) # skip pixels header
-                pixels = self._read_raw(pixels_size)
+                self.pixels = MipLevels(self.data, self.unswizzle_level)
+                self.pixels.add(self._read(pixels_size), pixels_size)
 
                 self._read(80) # skip palette header
                 if palette_format == PaletteType.PALETTE_8:
@@ -465,74 +469,85 @@ class NativePS2Texture(TextureNative):
 
                 if self.depth == 8:
                     self.palette = NativePS2Texture.unswizzle_palette(self.palette)
-                    pixels = NativePS2Texture.unswizzle8(pixels, self.width, self.height)
-                elif self.depth == 4:
-                    pixels = NativePS2Texture.unswizzle4(pixels, self.width, self.height)
-
-                self.pixels.append(pixels)
 
             elif self.depth == 32:
-                pixels = self._read_raw(pixels_size)
-                self.pixels.append(pixels)
+                self.pixels = MipLevels(self.data)
+                self.pixels.add(self._read(pixels_size), pixels_size)
 
         return self
 
+    #######################################################
+    def unswizzle_level(self, pixels, level):
+        if self.depth == 8:
+            return NativePS2Texture.unswizzle8(pixels, self.width, self.height)
+        elif self.depth == 4:
+            return NativePS2Texture.unswizzle4(pixels, self.width, self.height)
+        return pixels
+
     #######################################################
     @staticmethod
     def unswizzle8(data, width, height):
-        res = bytearray(width * height)
-        for y in range(height):
-            block_y = (y & ~0xf) * width
-            posY = (((y & ~3) >> 1) + (y & 1)) & 0x7
-            swap_selector = (((y + 2) >> 2) & 0x1) * 4
-            base_column_location = posY * width * 2
-
-            for x in range(width):
-                block_x = (x & ~0xf) * 2
-                column_location = base_column_location + ((x + swap_selector) & 0x7) * 4
-                byte_num = ((y >> 1) & 1) + ((x >> 2) & 2)
-                swizzleid = block_y + block_x + column_location + byte_num
-                res[y * width + x] = data[swizzleid]
-
-        return res
+        return swizzle.unswizzle(data, "ps2", width, height, 8)
 
     #######################################################
     @staticmethod
     def unswizzle4(data, width, height):
-        pixels = bytearray(width * height)
-        for i in range(width * height // 2):
-            index = data[i]
-            pixels[i*2] = index & 0xf
-            pixels[i*2+1] = (index >> 4) & 0xf
 
-        pixels = NativePS2Texture.unswizzle8(pixels, width, height)
+        # Rounded up, a 1x1 level still has one byte
+        count = (width * height + 1) // 2
+        data = bytes(data[:count]).ljust(count, b'\0')
 
-        res = bytearray(width * height // 2)
-        for i in range(width * height // 2):
-            idx1 = pixels[i*2]
-            idx2 = pixels[i*2+1]
-            res[i] = (idx2 << 4) | idx1
+        # Swizzled like 8 bit data, with one 4 bit index per byte
+        if numpy is not None:
+            data = numpy.frombuffer(data, dtype=numpy.uint8)
+            pixels = numpy.empty(count * 2, dtype=numpy.uint8)
+            pixels[0::2] = data & 0xf
+            pixels[1::2] = data >> 4
 
-        return res
+            unswizzled = numpy.zeros(count * 2, dtype=numpy.uint8)
+            unswizzled[:width * height] = pixels[swizzle.swizzle_map("ps2", width, height, 8)[1]]
+            return bytearray((unswizzled[0::2] | (unswizzled[1::2] << 4)).tobytes())
+
+        pixels = bytearray(count * 2)
+        pixels[0::2] = data.translate(bytes(i & 0xf for i in range(256)))
+        pixels[1::2] = data.translate(bytes(i >> 4 for i in range(256)))
+
+        pixels = NativePS2Texture.unswizzle8(pixels, width, height)
+        pixels.extend(bytes(count * 2 - len(pixels)))
+        high = bytes(pixels[1::2]).translate(bytes((i << 4) & 0xff for i in range(256)))
+        return bytearray(map(or_, pixels[0::2], high))
 
     #######################################################
     @staticmethod
     def unswizzle_palette(data):
-        palette = bytearray(1024)
-        for p in range(256):
-            pos_l = ((p & 231) | ((p & 8) << 1) | ((p & 16) >> 1)) * 4
-            pos_r = p * 4
-            palette[pos_l:pos_l+4] = data[pos_r:pos_r+4]
-        return bytes(palette)
+
+        # Swaps bits 3 and 4 of each color's index, which is its own inverse
+        palette_map = NativePS2Texture.palette_map()
+
+        if numpy is not None:
+            data = numpy.frombuffer(data, dtype=numpy.uint32, count=256)
+            return data[palette_map].tobytes()
+
+        return b''.join([data[p*4:p*4+4] for p in palette_map])
+
+    #######################################################
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def palette_map():
+        palette_map = [(p & 231) | ((p & 8) << 1) | ((p & 16) >> 1) for p in range(256)]
+
+        if numpy is not None:
+            return numpy.array(palette_map, dtype=numpy.intp)
+        return palette_map
 
     #######################################################
     def _read_palette(self, size):
-        palette = bytearray(size)
-        data = self._read_raw(size)
-        for i in range(0, size, 4):
-            r, g, b, a = data[i:i+4]
-            palette[i:i+3] = r, g, b
-            palette[i+3] = min(a * 2, 255)
+        palette = bytearray(self._read_raw(size))
+
+        # Alpha is stored as 0-128
+        palette[3::4] = bytes(palette[3::4]).translate(
+            bytes(min(a * 2, 255) for a in range(256))
+        )
         return bytes(palette)
 
     #######################################################
@@ -545,7 +560,7 @@ class NativePS2Texture(TextureNative):
     #######################################################
     def _read_raw(self, size):
         offset = self._read(size)
-        return self.data[offset:offset+size]
+        return bytes(self.data[offset:offset+size])
 
     #######################################################
     def _read_chunk(self):
@@ -17,7 +17,8 @@
 from struct import unpack_from, calcsize
 
 from .dff import RGBA, TexCoords, Triangle, Vector
-from .txd import TextureNative, PaletteType
+from .txd import MipLevels, TextureNative, PaletteType
+from . import swizzle
 
 # geometry flags
 rpGEOMETRYTRISTRIP              = 0x00000001
@@ -374,41 +375,24 @@ class NativePSPTexture(TextureNative):
         elif palette_format == PaletteType.PALETTE_4:
             self.palette = self._read_raw(64)
 
+        self.pixels = MipLevels(data, self.unswizzle_level)
         for i in range(self.num_levels):
             width, height = self.get_width(i), self.get_height(i)
             data_len = width * height * self.depth // 8
 
-            pixels = self._read_raw(data_len)
-            pixels = NativePSPTexture.unswizzle(pixels, width, height, self.depth)
-
-            self.pixels.append(pixels)
+            self.pixels.add(self._read(data_len), data_len)
 
         return self
 
+    #######################################################
+    def unswizzle_level(self, pixels, level):
+        width, height = self.get_width(level), self.get_height(level)
+        return NativePSPTexture.unswizzle(pixels, width, height, self.depth)
+
     #######################################################
     @staticmethod
     def unswizzle(data, width, height, depth):
-        width = (width * depth) >> 3
-        res = bytearray(width * height)
-
-        row_blocks = width // 16
-        block_size = 16 * 8
-
-        for y in range(height):
-            block_y = y // 8
-            y_in_block = y % 8
-
-            for x in range(width):
-                block_x = x // 16
-                x_in_block = x % 16
-
-                block_idx = block_x + (block_y * row_blocks)
-                src_off = (block_idx * block_size) + x_in_block + y_in_block * 16
-                dst_off = y * width + x
-
-                res[dst_off] = data[src_off]
-
-        return res
+        return swizzle.unswizzle(data, "psp", width, height, depth)
 
     #######################################################
     @staticmethod
@@ -434,4 +418,4 @@ class NativePSPTexture(TextureNative):
     #######################################################
     def _read_raw(self, size):
         offset = self._read(size)
-        return self.data[offset:offset+size]
+        return bytes(self.data[offset:offset+size])
@@ -17,7 +17,8 @@
 from struct import unpack_from, calcsize
 
 from .dff import RGBA, Sections, TexCoords, Triangle, Vector
-from .txd import ImageDecoder, TextureNative, PaletteType
+from .txd import ImageDecoder, MipLevels, TextureNative, PaletteType
+from . import swizzle
 
 # geometry flags
 rpGEOMETRYTRISTRIP              = 0x00000001
@@ -289,6 +290,7 @@ class NativeXboxTexture(TextureNative):
 
         self.convert_palette()
 
+        self.pixels = MipLevels(data, None if self.compression else self.unswizzle_level)
         for i in range(self.num_levels):
             width, height = self.get_width(i), self.get_height(i)
 
@@ -299,14 +301,15 @@ class NativeXboxTexture(TextureNative):
             else:
                 data_len = width * height * self.depth // 8
 
-            pixels = self._read_raw(data_len)
-            if not self.compression:
-                pixels = NativeXboxTexture.unswizzle(pixels, width, height, self.depth // 8)
-
-            self.pixels.append(pixels)
+            self.pixels.add(self._read(data_len), data_len)
 
         return self
 
+    #######################################################
+    def unswizzle_level(self, pixels, level):
+        width, height = self.get_width(level), self.get_height(level)
+        return NativeXboxTexture.unswizzle(pixels, width, height, self.depth // 8)
+
     #######################################################
     def convert_palette(self):
         palette = self.palette
@@ -323,37 +326,7 @@ class NativeXboxTexture(TextureNative):
     #######################################################
     @staticmethod
     def unswizzle(data, width, height, bpp):
-        maskU = 0
-        maskV = 0
-        i = 1
-        j = 1
-
-        while True:
-            if i < width:
-                maskU |= j
-                j <<= 1
-
-            if i < height:
-                maskV |= j
-                j <<= 1
-
-            i <<= 1
-            if i >= width and i >= height:
-                break
-
-        res = bytearray(width * height * bpp)
-
-        v = 0
-        for y in range(height):
-            u = 0
-            for x in range(width):
-                src_pos = (u | v) * bpp
-                dst_pos = (y * width + x) * bpp
-                res[dst_pos:dst_pos+bpp] = data[src_pos:src_pos+bpp]
-                u = (u - maskU) & maskU
-            v = (v - maskV) & maskV
-
-        return res
+        return swizzle.unswizzle(data, "xbox", width, height, bpp * 8)
 
     #######################################################
     def _read(self, size):
@@ -365,4 +338,4 @@ class NativeXboxTexture(TextureNative):
     #######################################################
     def _read_raw(self, size):
         offset = self._read(size)
-        return self.data[offset:offset+size]
+        return bytes(self.data[offset:offset+size])
@@ -0,0 +1,161 @@
+# GTA DragonFF - Blender scripts to edit basic GTA formats
+# Copyright (C) 2019  Parik
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from functools import lru_cache
+
+from .txd import numpy
+
+# Console textures store their pixels in a platform specific order. Instead
+# of computing the address of every pixel on each decode, the order is
+# computed once per platform, size and depth as a list of indices: for each
+# unit (a run of bytes that stays together) of the linear image, in row
+# order, the index of that unit in the swizzled data.
+
+#######################################################
+def _ps2(width, height, bpp):
+
+    # 8 bit PS2 textures, 4 bit ones use the same map for their nibbles
+    def swizzle_id(y, x):
+        block_y = (y & ~0xf) * width
+        posY = (((y & ~3) >> 1) + (y & 1)) & 0x7
+        swap_selector = (((y + 2) >> 2) & 0x1) * 4
+        base_column_location = posY * width * 2
+
+        block_x = (x & ~0xf) * 2
+        column_location = base_column_location + ((x + swap_selector) & 0x7) * 4
+        byte_num = ((y >> 1) & 1) + ((x >> 2) & 2)
+        return block_y + block_x + column_location + byte_num
+
+    if numpy is not None:
+        y = numpy.arange(height, dtype=numpy.intp)[:, None]
+        x = numpy.arange(width, dtype=numpy.intp)[None, :]
+        return 1, swizzle_id(y, x).ravel()
+
+    return 1, [swizzle_id(y, x) for y in range(height) for x in range(width)]
+
+#######################################################
+def _xbox(width, height, bpp):
+
+    # Morton order, one unit per pixel. Xbox has no swizzled format with
+    # less than a byte per pixel.
+    if bpp < 8:
+        raise ValueError("Invalid Xbox swizzled depth: %d" % bpp)
+
+    maskU = 0
+    maskV = 0
+    i = 1
+    j = 1
+
+    while True:
+        if i < width:
+            maskU |= j
+            j <<= 1
+
+        if i < height:
+            maskV |= j
+            j <<= 1
+
+        i <<= 1
+        if i >= width and i >= height:
+            break
+
+    def bits_sequence(count, mask):
+        values, value = [], 0
+        for _ in range(count):
+            values.append(value)
+            value = (value - mask) & mask
+        return values
+
+    u = bits_sequence(width, maskU)
+    v = bits_sequence(height, maskV)
+
+    if numpy is not None:
+        indices = numpy.array(v, dtype=numpy.intp)[:, None] | numpy.array(u, dtype=numpy.intp)
+        return bpp // 8, indices.ravel()
+
+    return bpp // 8, [row | col for row in v for col in u]
+
+#######################################################
+def _gc(width, height, bpp):
+
+    # Blocks of bw x bh pixels, one unit per row of a block. width and
+    # height are the sizes aligned to the block size.
+    bw, bh = (8, 8) if bpp == 4 else (8, 4) if bpp == 8 else (4, 4)
+    blocks_x = width // bw
+
+    def strip_id(y, x):
+        return ((y // bh) * blocks_x + x) * bh + y % bh
+
+    if numpy is not None:
+        y = numpy.arange(height, dtype=numpy.intp)[:, None]
+        x = numpy.arange(blocks_x, dtype=numpy.intp)[None, :]
+        return bpp * bw // 8, strip_id(y, x).ravel()
+
+    return bpp * bw // 8, [strip_id(y, x) for y in range(height) for x in range(blocks_x)]
+
+#######################################################
+def _psp(width, height, bpp):
+
+    # Blocks of 16 bytes x 8 rows
+    width = (width * bpp) >> 3
+    row_blocks = width // 16
+
+    def byte_id(y, x):
+        block_idx = x // 16 + (y // 8) * row_blocks
+        return block_idx * 128 + x % 16 + (y % 8) * 16
+
+    if numpy is not None:
+        y = numpy.arange(height, dtype=numpy.intp)[:, None]
+        x = numpy.arange(width, dtype=numpy.intp)[None, :]
+        return 1, byte_id(y, x).ravel()
+
+    return 1, [byte_id(y, x) for y in range(height) for x in range(width)]
+
+_builders = {
+    "ps2"  : _ps2,
+    "xbox" : _xbox,
+    "gc"   : _gc,
+    "psp"  : _psp,
+}
+
+#######################################################
+@lru_cache(maxsize=64)
+def swizzle_map(platform, width, height, bpp):
+
+    # Maps are shared by every caller through the cache, so they are made
+    # read only
+    unit, indices = _builders[platform](width, height, bpp)
+
+    if numpy is not None:
+        indices.flags.writeable = False
+    else:
+        indices = tuple(indices)
+
+    return unit, indices
+
+#######################################################
+def unswizzle(data, platform, width, height, bpp):
+
+    unit, indices = swizzle_map(platform, width, height, bpp)
+
+    if numpy is not None:
+        data = numpy.frombuffer(data, numpy.dtype((numpy.void, unit)), len(data) // unit)
+        return bytearray(data[indices].tobytes())
+
+    if unit == 1:
+        return bytearray(map(data.__getitem__, indices))
+
+    return bytearray(b''.join([data[i*unit:i*unit+unit] for i in indices]))
@@ -0,0 +1,151 @@
+# GTA DragonFF - Blender scripts to edit basic GTA formats
+# Copyright (C) 2019  Parik
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from dataclasses import dataclass
+from struct import unpack_from
+
+from .dff import Sections, types
+
+# Chunks whose payload is only made of other chunks. Everything else
+# (Struct, plugins, ...) is indexed but not descended into.
+container_types = {
+    types["Extension"],
+    types["Texture"],
+    types["Material"],
+    types["Material List"],
+    types["Frame List"],
+    types["Geometry"],
+    types["Clump"],
+    types["Atomic"],
+    types["Texture Native"],
+    types["Texture Dictionary"],
+    types["Geometry List"],
+    types["UV Animation Dictionary"],
+    types["UV Animation PLG"],
+}
+
+#######################################################
+@dataclass
+class ChunkEntry:
+    type: int
+    offset: int
+    size: int
+    library_id: int
+    depth: int
+    parent: int
+
+    #######################################################
+    @property
+    def data_offset(self):
+        return self.offset + 12
+
+    #######################################################
+    @property
+    def end(self):
+        return self.offset + 12 + self.size
+
+    #######################################################
+    @property
+    def rw_version(self):
+        return Sections.get_rw_version(self.library_id)
+
+#######################################################
+class toc:
+
+    # Flat index of the chunk tree of a RenderWare stream (DFF, TXD, UV
+    # animation dictionary), in file order. Only chunk headers are read.
+
+    #######################################################
+    def _walk(self, data, pos, end, depth, parent):
+
+        while pos + 12 <= end:
+            chunk_type, size, library_id = unpack_from("<3I", data, pos)
+
+            # Stop at padding or garbage at the end of the parent chunk
+            if chunk_type == 0 and size == 0:
+                break
+
+            index = len(self.entries)
+            self.entries.append(
+                ChunkEntry(chunk_type, pos, size, library_id, depth, parent)
+            )
+
+            chunk_end = min(pos + 12 + size, end)
+            if chunk_type in container_types:
+                self._walk(data, pos + 12, chunk_end, depth + 1, index)
+
+            pos = chunk_end
+
+    #######################################################
+    def load_memory(self, data, start=0, end=None):
+
+        # Indexes data[start:end], offsets stay relative to the whole data
+        if end is None:
+            end = len(data)
+
+        self.clear()
+        self._walk(data, start, end, 0, -1)
+
+    #######################################################
+    def load_file(self, filename):
+
+        with open(filename, mode='rb') as file:
+            content = file.read()
+            self.load_memory(content)
+
+    #######################################################
+    def find(self, chunk_type, start=0):
+        return next(
+            (idx for idx in range(start, len(self.entries))
+             if self.entries[idx].type == chunk_type),
+            -1
+        )
+
+    #######################################################
+    def find_all(self, chunk_type, parent=None):
+        return [
+            entry for entry in self.entries
+            if entry.type == chunk_type and
+            (parent is None or entry.parent == parent)
+        ]
+
+    #######################################################
+    def children(self, entry_idx):
+        return [entry for entry in self.entries if entry.parent == entry_idx]
+
+    #######################################################
+    def chunk_types(self):
+        return {entry.type for entry in self.entries}
+
+    #######################################################
+    def clear(self):
+        self.entries = []
+
+    #######################################################
+    def __init__(self):
+        self.entries: list[ChunkEntry] = []
+
+    #######################################################
+    def __contains__(self, chunk_type):
+        return any(entry.type == chunk_type for entry in self.entries)
+
+    #######################################################
+    def __iter__(self):
+        return iter(self.entries)
+
+    #######################################################
+    def __len__(self):
+        return len(self.entries)
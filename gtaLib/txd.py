@@ -19,10 +19,16 @@ from math import ceil
 from struct import unpack_from, pack
 from collections import namedtuple
 
-from .dff import Sections, NativePlatformType
+from .dff import Sections, WriterContext, NativePlatformType
 from .dff import types, Chunk, TexDict, PITexDict, Texture
 from .dff import strlen
 
+# NumPy ships with Blender, but keep the pure Python decoders working without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 #######################################################
 class RasterFormat(IntEnum):
     RASTER_DEFAULT = 0x00
@@ -46,6 +52,7 @@ class D3DFormat(IntEnum):
     D3D_1555 = 25
     D3D_4444 = 26
 
+    D3DFMT_P8   = 41
     D3DFMT_L8   = 50
     D3DFMT_A8L8 = 51
 
@@ -85,20 +92,271 @@ class ImageEncoder:
     
     @staticmethod
     def rgba_to_bgra8888(rgba_data):
-        ret = bytearray()
-        for i in range(0, len(rgba_data), 4):
-            r, g, b, a = rgba_data[i:i+4]
-            ret.extend([b, g, r, a])
+        ret = bytearray(rgba_data)
+        ret[0::4] = rgba_data[2::4]
+        ret[2::4] = rgba_data[0::4]
         return bytes(ret)
     
     @staticmethod
     def rgba_to_bgra888(rgba_data):
-        ret = bytearray()
-        for i in range(0, len(rgba_data), 4):
-            r, g, b = rgba_data[i:i+3]
-            ret.extend([b, g, r])
+        ret = bytearray(len(rgba_data) // 4 * 3)
+        ret[0::3] = rgba_data[2::4]
+        ret[1::3] = rgba_data[1::4]
+        ret[2::3] = rgba_data[0::4]
         return bytes(ret)
 
+    @staticmethod
+    def downsample(rgba_data, width, height):
+
+        # Next mip level of an RGBA image, averaging 2x2 pixels (2x1 or 1x2
+        # once a side is down to one pixel). An odd last row or column is
+        # dropped.
+        new_width, new_height = max(width // 2, 1), max(height // 2, 1)
+        step_x, step_y = (2 if width > 1 else 1), (2 if height > 1 else 1)
+        count = step_x * step_y
+
+        if numpy is not None:
+            image = numpy.frombuffer(rgba_data, numpy.uint8, width * height * 4)
+            image = image.reshape(height, width, 4)[:new_height * step_y, :new_width * step_x]
+            image = image.reshape(new_height, step_y, new_width, step_x, 4)
+            image = image.sum(axis=(1, 3), dtype=numpy.uint32)
+            return ((image + count // 2) // count).astype(numpy.uint8).tobytes(), new_width, new_height
+
+        row_len = width * 4
+        new_row_len = new_width * 4
+        ret = bytearray(new_row_len * new_height)
+
+        for y in range(new_height):
+            rows = [rgba_data[row_len*(y*step_y+j):row_len*(y*step_y+j+1)] for j in range(step_y)]
+            for c in range(4):
+                samples = [row[c+4*i::4*step_x][:new_width] for row in rows for i in range(step_x)]
+                sums = map(sum, zip(*samples))
+                ret[y*new_row_len+c:(y+1)*new_row_len:4] = bytes((v + count // 2) // count for v in sums)
+
+        return bytes(ret), new_width, new_height
+
+    # Palette quantization, NumPy only. The palette is built by median cut
+    # over the image's distinct colours, then every pixel (optionally with
+    # ordered dithering) takes the nearest palette entry.
+
+    @staticmethod
+    def median_cut(rgba_data, colors):
+
+        # Returns a palette of colors RGBA entries, unused ones left black.
+        # Pixels are first binned by their top 5 bits per channel, each bin
+        # standing for the mean of its pixels.
+        pixels = numpy.frombuffer(rgba_data, numpy.uint32)
+        palette = numpy.zeros((colors, 4), numpy.uint8)
+
+        bins, inverse, counts = numpy.unique(
+            pixels & numpy.uint32(0xf8f8f8f8), return_inverse=True, return_counts=True
+        )
+
+        # Images with few colours keep them exactly
+        if len(bins) <= colors:
+            distinct = numpy.unique(pixels)
+            if len(distinct) <= colors:
+                palette[:len(distinct)] = distinct.view(numpy.uint8).reshape(-1, 4)
+                return palette.tobytes()
+        channels = pixels.view(numpy.uint8).reshape(-1, 4)
+        values = numpy.stack([
+            numpy.bincount(inverse.ravel(), channels[:, i], len(bins)) for i in range(4)
+        ], axis=1) / counts[:, None]
+
+        def score(box):
+            return (values[box].max(axis=0) - values[box].min(axis=0)).max()
+
+        boxes = [numpy.arange(len(values))]
+        scores = [score(boxes[0])]
+
+        # Split the box with the widest channel at its population median
+        while len(boxes) < colors:
+            idx = int(numpy.argmax(scores))
+            if scores[idx] == 0:
+                break
+
+            box = boxes[idx]
+            channel = numpy.argmax(values[box].max(axis=0) - values[box].min(axis=0))
+            box = box[numpy.argsort(values[box, channel], kind='stable')]
+
+            population = numpy.cumsum(counts[box])
+            split = numpy.searchsorted(population, population[-1] / 2) + 1
+            split = min(max(split, 1), len(box) - 1)
+
+            boxes[idx:idx+1] = box[:split], box[split:]
+            scores[idx:idx+1] = score(box[:split]), score(box[split:])
+
+        for i, box in enumerate(boxes):
+            weights = counts[box]
+            palette[i] = numpy.rint((values[box] * weights[:, None]).sum(axis=0) / weights.sum())
+
+        return palette.tobytes()
+
+    @staticmethod
+    def rgba_to_pal(rgba_data, width, height, palette, depth, dither=False):
+
+        # Maps an image to palette indices, one byte per pixel for 8 bit and
+        # two pixels per byte (high nibble first) for 4 bit
+        pixels = numpy.frombuffer(rgba_data, numpy.uint8, width * height * 4)
+        pixels = pixels.reshape(-1, 4).astype(numpy.float32)
+        palette = numpy.frombuffer(palette, numpy.uint8).reshape(-1, 4)[:1 << depth]
+        palette = palette.astype(numpy.float32)
+
+        if dither:
+            # 4x4 Bayer matrix, scaled to the average palette spacing
+            bayer = numpy.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]])
+            spread = 0x100 / len(palette) ** (1 / 3)
+            offsets = (numpy.tile(bayer, ((height + 3) // 4, (width + 3) // 4))[:height, :width] + 0.5) / 16 - 0.5
+            pixels[:, :3] += (offsets.reshape(-1, 1) * spread).astype(numpy.float32)
+
+        # Nearest entry by |p|^2 - 2 x.p, in chunks to bound memory
+        norms = (palette ** 2).sum(axis=1)
+        indices = numpy.empty(len(pixels), numpy.uint8)
+        for start in range(0, len(pixels), 0x4000):
+            chunk = pixels[start:start+0x4000]
+            indices[start:start+0x4000] = (norms - 2 * chunk @ palette.T).argmin(axis=1)
+
+        if depth == 4:
+            if len(indices) % 2:
+                indices = numpy.append(indices, numpy.uint8(0))
+            indices = (indices[0::2] << 4) | indices[1::2]
+
+        return indices.tobytes()
+
+    # BCn (DXT) compression, NumPy only. Colour endpoints are fitted along
+    # the principal axis of each block's colours, then every pixel takes
+    # the nearest colour the decoder will produce from them.
+
+    @staticmethod
+    def _image_to_blocks(rgba_data, width, height):
+
+        # Splits an image into (N, 16, 4) row ordered 4x4 blocks, repeating
+        # the last row and column to fill partial blocks
+        blocks_x, blocks_y = (width + 3) // 4, (height + 3) // 4
+        image = numpy.frombuffer(rgba_data, numpy.uint8, width * height * 4)
+        image = numpy.pad(
+            image.reshape(height, width, 4),
+            ((0, blocks_y * 4 - height), (0, blocks_x * 4 - width), (0, 0)),
+            mode='edge'
+        )
+        image = image.reshape(blocks_y, 4, blocks_x, 4, 4).transpose(0, 2, 1, 3, 4)
+        return image.reshape(-1, 16, 4)
+
+    @staticmethod
+    def _pack_indices(indices, bits_per_index, dtype):
+        shifts = numpy.arange(0, 16 * bits_per_index, bits_per_index).astype(numpy.uint64)
+        return (indices.astype(numpy.uint64) << shifts).sum(axis=1, dtype=numpy.uint64).astype(dtype)
+
+    @staticmethod
+    def _bc_color_blocks(blocks, punch_through=False):
+
+        # Returns the 565 endpoints and packed indices of the colour part of
+        # each block. With punch_through (DXT1 with alpha), pixels with alpha
+        # below 128 get the transparent index and are ignored for the fit.
+        colors = blocks[:, :, :3].astype(numpy.float64)
+        if punch_through:
+            weights = (blocks[:, :, 3] >= 0x80).astype(numpy.float64)
+        else:
+            weights = numpy.ones(blocks.shape[:2])
+
+        count = numpy.maximum(weights.sum(axis=1, keepdims=True), 1)
+        mean = (colors * weights[:, :, None]).sum(axis=1) / count
+        centered = (colors - mean[:, None]) * weights[:, :, None]
+
+        # Principal axis by power iteration on the covariance matrices
+        covariance = numpy.einsum('nki,nkj->nij', centered, centered)
+        axis = numpy.ones_like(mean)
+        for _ in range(8):
+            axis = numpy.einsum('nij,nj->ni', covariance, axis)
+            norm = numpy.linalg.norm(axis, axis=1, keepdims=True)
+            axis = numpy.divide(axis, norm, out=numpy.zeros_like(axis), where=norm > 0)
+
+        projection = numpy.einsum('nki,ni->nk', centered, axis)
+        used = weights > 0
+        t_max = numpy.where(used, projection, -numpy.inf).max(axis=1, initial=0)[:, None]
+        t_min = numpy.where(used, projection, numpy.inf).min(axis=1, initial=0)[:, None]
+
+        def encode565(color):
+            color = numpy.clip(color, 0, 0xff)
+            r = numpy.rint(color[:, 0] * 0x1f / 0xff).astype(numpy.uint16)
+            g = numpy.rint(color[:, 1] * 0x3f / 0xff).astype(numpy.uint16)
+            b = numpy.rint(color[:, 2] * 0x1f / 0xff).astype(numpy.uint16)
+            return (r << 11) | (g << 5) | b
+
+        color0 = encode565(mean + t_max * axis)
+        color1 = encode565(mean + t_min * axis)
+
+        # Four colour mode needs color0 > color1, punch through the reverse
+        swap = color0 > color1 if punch_through else color0 < color1
+        color0, color1 = numpy.where(swap, color1, color0), numpy.where(swap, color0, color1)
+
+        palette, opaque = ImageDecoder._bc_palette(color0, color1)
+        distances = ((colors[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(axis=3)
+
+        # In three colour mode index 3 is transparent
+        distances[:, :, 3] = numpy.where(opaque, distances[:, :, 3], numpy.inf)
+        indices = distances.argmin(axis=2)
+        if punch_through:
+            indices[~used] = 3
+
+        return color0, color1, ImageEncoder._pack_indices(indices, 2, numpy.uint32)
+
+    @staticmethod
+    def _bc_write(block_dtype, count, **fields):
+        blocks = numpy.empty(count, block_dtype)
+        for name, values in fields.items():
+            blocks[name] = values
+        return blocks.tobytes()
+
+    @staticmethod
+    def rgba_to_bc1(rgba_data, width, height, alpha=False):
+        blocks = ImageEncoder._image_to_blocks(rgba_data, width, height)
+        color0, color1, bits = ImageEncoder._bc_color_blocks(blocks, alpha)
+
+        return ImageEncoder._bc_write(
+            numpy.dtype([('c0', '<u2'), ('c1', '<u2'), ('bits', '<u4')]),
+            len(blocks), c0=color0, c1=color1, bits=bits
+        )
+
+    @staticmethod
+    def rgba_to_bc2(rgba_data, width, height):
+        blocks = ImageEncoder._image_to_blocks(rgba_data, width, height)
+        color0, color1, bits = ImageEncoder._bc_color_blocks(blocks)
+
+        alpha = numpy.rint(blocks[:, :, 3] / 0x11)
+        alpha = ImageEncoder._pack_indices(alpha, 4, numpy.uint64)
+
+        return ImageEncoder._bc_write(
+            numpy.dtype([('alpha', '<u8'), ('c0', '<u2'), ('c1', '<u2'), ('bits', '<u4')]),
+            len(blocks), alpha=alpha, c0=color0, c1=color1, bits=bits
+        )
+
+    @staticmethod
+    def rgba_to_bc3(rgba_data, width, height):
+        blocks = ImageEncoder._image_to_blocks(rgba_data, width, height)
+        color0, color1, bits = ImageEncoder._bc_color_blocks(blocks)
+
+        # Eight alpha mode between the block's extremes, same rounding as
+        # the decoder
+        alpha = blocks[:, :, 3].astype(numpy.float64)
+        a0 = alpha.max(axis=1, keepdims=True)
+        a1 = alpha.min(axis=1, keepdims=True)
+        weights7 = numpy.array([6, 5, 4, 3, 2, 1]) / 7
+        alphas = numpy.concatenate(
+            (a0, a1, numpy.round(a0 * weights7 + a1 * weights7[::-1])), axis=1
+        )
+
+        alpha_indices = numpy.abs(alpha[:, :, None] - alphas[:, None, :]).argmin(axis=2)
+        alpha_bits = ImageEncoder._pack_indices(alpha_indices, 3, numpy.uint64)
+        alpha_bits = alpha_bits.astype('<u8').view(numpy.uint8).reshape(-1, 8)[:, :6]
+
+        return ImageEncoder._bc_write(
+            numpy.dtype([('a0', 'u1'), ('a1', 'u1'), ('alpha', 'u1', 6),
+                         ('c0', '<u2'), ('c1', '<u2'), ('bits', '<u4')]),
+            len(blocks), a0=a0[:, 0], a1=a1[:, 0], alpha=alpha_bits,
+            c0=color0, c1=color1, bits=bits
+        )
+
 #######################################################
 class ImageDecoder:
 
@@ -152,8 +410,96 @@ class ImageDecoder:
     def _c3(a, b):
         return (2 * b + a) // 3
 
+    @staticmethod
+    def _bc_palette(color0, color1):
+
+        # The four RGB colours of N BCn blocks from their 565 endpoints, and
+        # whether each block is in four colour (opaque) mode
+        def decode565(bits):
+            bits = bits.astype(numpy.int32)
+            return numpy.stack((
+                ((bits >> 11) & 0x1f) * 0xff // 0x1f,
+                ((bits >> 5) & 0x3f) * 0xff // 0x3f,
+                (bits & 0x1f) * 0xff // 0x1f
+            ), axis=-1)
+
+        c0, c1 = decode565(color0), decode565(color1)
+        opaque = (color0 > color1)[:, None]
+
+        palette = numpy.stack((
+            c0,
+            c1,
+            numpy.where(opaque, (2 * c0 + c1) // 3, (c0 + c1) // 2),
+            numpy.where(opaque, (2 * c1 + c0) // 3, 0)
+        ), axis=1)
+
+        return palette, opaque
+
+    @staticmethod
+    def _bc_colors(color0, color1, indices, alpha_flag=None):
+
+        # Decodes the colour part of N BCn blocks at once. color0 and color1
+        # are the N 565 endpoints, indices the (N, 16) 2 bit codes of each
+        # block's pixels in row order. Returns (N, 16, 4) RGBA, with BC1
+        # alpha if alpha_flag is given, otherwise alpha is left at 0xff.
+        palette, opaque = ImageDecoder._bc_palette(color0, color1)
+
+        rgba = numpy.full((len(indices), 16, 4), 0xff, dtype=numpy.uint8)
+        rgba[:, :, :3] = numpy.take_along_axis(palette, indices[:, :, None], axis=1)
+
+        if alpha_flag is not None:
+            transparent = (indices == 3) & ~opaque
+            rgba[:, :, 3] = numpy.where(transparent, 0, 0xff) | alpha_flag
+
+        return rgba
+
+    @staticmethod
+    def _bc_premultiply(rgba):
+
+        # Undo premultiplied alpha of DXT2 and DXT4
+        alpha = rgba[:, :, 3:].astype(numpy.float64)
+        colors = rgba[:, :, :3].astype(numpy.float64)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            unmultiplied = numpy.minimum(numpy.round(colors * 255 / alpha), 255)
+
+        rgba[:, :, :3] = numpy.where(alpha > 0, unmultiplied, colors)
+
+    @staticmethod
+    def _blocks_to_image(blocks, blocks_x, blocks_y, width, height):
+
+        # Lays out (blocks_y * blocks_x, 16, 4) row ordered 4x4 blocks
+        image = blocks.reshape(blocks_y, blocks_x, 4, 4, 4)
+        image = image.transpose(0, 2, 1, 3, 4).reshape(blocks_y * 4, blocks_x * 4, 4)
+        return image[:height, :width].tobytes()
+
+    @staticmethod
+    def _bc_blocks(data, width, height, block_dtype):
+        blocks_x, blocks_y = (width + 3) // 4, (height + 3) // 4
+        blocks = numpy.frombuffer(data, block_dtype, blocks_x * blocks_y)
+        return blocks, blocks_x, blocks_y
+
+    @staticmethod
+    def _bc_indices(bits, count, shift):
+        # shift is where the first pixel's code is and how it moves per pixel
+        start, step = shift
+        shifts = numpy.arange(start, start + step * count, step).astype(numpy.uint64)
+        return ((bits.astype(numpy.uint64)[:, None] >> shifts) & (2 ** abs(step) - 1)).astype(numpy.intp)
+
     @staticmethod
     def bc1(data, width, height, alpha_flag):
+        if numpy is not None:
+            blocks, blocks_x, blocks_y = ImageDecoder._bc_blocks(
+                data, width, height,
+                numpy.dtype([('c0', '<u2'), ('c1', '<u2'), ('bits', '<u4')])
+            )
+            rgba = ImageDecoder._bc_colors(
+                blocks['c0'], blocks['c1'],
+                ImageDecoder._bc_indices(blocks['bits'], 16, (0, 2)),
+                alpha_flag
+            )
+            return ImageDecoder._blocks_to_image(rgba, blocks_x, blocks_y, width, height)
+
         pos = 0
         ret = bytearray(4 * width * height)
 
@@ -193,6 +539,21 @@ class ImageDecoder:
 
     @staticmethod
     def bc2(data, width, height, premultiplied):
+        if numpy is not None:
+            blocks, blocks_x, blocks_y = ImageDecoder._bc_blocks(
+                data, width, height,
+                numpy.dtype([('alpha', '<u8'), ('c0', '<u2'), ('c1', '<u2'), ('bits', '<u4')])
+            )
+            rgba = ImageDecoder._bc_colors(
+                blocks['c0'], blocks['c1'],
+                ImageDecoder._bc_indices(blocks['bits'], 16, (0, 2))
+            )
+            rgba[:, :, 3] = ImageDecoder._bc_indices(blocks['alpha'], 16, (0, 4)) * 0x11
+
+            if premultiplied:
+                ImageDecoder._bc_premultiply(rgba)
+            return ImageDecoder._blocks_to_image(rgba, blocks_x, blocks_y, width, height)
+
         pos = 0
         ret = bytearray(4 * width * height)
 
@@ -238,6 +599,45 @@ class ImageDecoder:
 
     @staticmethod
     def bc3(data, width, height, premultiplied):
+        if numpy is not None:
+            blocks, blocks_x, blocks_y = ImageDecoder._bc_blocks(
+                data, width, height,
+                numpy.dtype([('a0', 'u1'), ('a1', 'u1'), ('alpha', 'u1', 6),
+                             ('c0', '<u2'), ('c1', '<u2'), ('bits', '<u4')])
+            )
+            rgba = ImageDecoder._bc_colors(
+                blocks['c0'], blocks['c1'],
+                ImageDecoder._bc_indices(blocks['bits'], 16, (0, 2))
+            )
+
+            # Calculate alpha values, same float math as the Python version
+            a0 = blocks['a0'].astype(numpy.float64)[:, None]
+            a1 = blocks['a1'].astype(numpy.float64)[:, None]
+            weights7 = numpy.array([6, 5, 4, 3, 2, 1]) / 7
+            weights5 = numpy.array([4, 3, 2, 1]) / 5
+
+            alphas = numpy.empty((len(blocks), 8))
+            alphas[:, 0:1], alphas[:, 1:2] = a0, a1
+            alphas[:, 2:] = numpy.where(
+                a0 > a1,
+                numpy.round(a0 * weights7 + a1 * weights7[::-1]),
+                numpy.concatenate((
+                    numpy.round(a0 * weights5 + a1 * weights5[::-1]),
+                    numpy.zeros_like(a0),
+                    numpy.full_like(a0, 255)
+                ), axis=1)
+            )
+
+            alpha_bits = blocks['alpha'].astype(numpy.uint64)
+            alpha_indices = sum(alpha_bits[:, i] << numpy.uint64(8 * i) for i in range(6))
+            alpha_indices = ImageDecoder._bc_indices(alpha_indices, 16, (0, 3))
+
+            rgba[:, :, 3] = numpy.take_along_axis(alphas, alpha_indices, axis=1)
+
+            if premultiplied:
+                ImageDecoder._bc_premultiply(rgba)
+            return ImageDecoder._blocks_to_image(rgba, blocks_x, blocks_y, width, height)
+
         pos = 0
         ret = bytearray(4 * width * height)
 
@@ -318,133 +718,190 @@ class ImageDecoder:
         return bytes(ret)
 
     @staticmethod
-    def bgra1555(data, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
+    def _rgba1555(bits):
+        a, r, g, b = ImageDecoder._decode1555(bits)
+        return r, g, b, a
 
-        for i in range(0, len(data), 2):
-            color = unpack_from("<H", data, i)[0]
-            a, r, g, b = ImageDecoder._decode1555(color)
-            ret[pos:pos+4] = r, g, b, a
-            pos += 4
-        return bytes(ret)
+    @staticmethod
+    def _rgba4444(bits):
+        a, r, g, b = ImageDecoder._decode4444(bits)
+        return r, g, b, a
 
     @staticmethod
-    def bgra4444(data, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
+    def _rgba555(bits):
+        return ImageDecoder._decode555(bits) + (0xff,)
 
-        for i in range(0, len(data), 2):
-            color = unpack_from("<H", data, i)[0]
-            a, r, g, b = ImageDecoder._decode4444(color)
-            ret[pos:pos+4] = r, g, b, a
-            pos += 4
-        return bytes(ret)
+    @staticmethod
+    def _rgba565(bits):
+        return ImageDecoder._decode565(bits) + (0xff,)
+
+    # Every possible 16 bit value decoded to RGBA, for when NumPy is missing
+    _tables16 = {}
 
     @staticmethod
-    def bgra555(data, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
+    def _to_size(pixels, width, height):
 
-        for i in range(0, len(data), 2):
-            color = unpack_from("<H", data, i)[0]
-            r, g, b = ImageDecoder._decode555(color)
-            ret[pos:pos+4] = r, g, b, 0xff
-            pos += 4
+        # Decoders used to write into a zeroed buffer of the image size
+        ret = bytearray(4 * width * height)
+        ret[:len(pixels)] = pixels
         return bytes(ret)
 
     @staticmethod
-    def bgra565(data, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
+    def _convert16(data, width, height, rgba):
+
+        # rgba is one of the _rgbaXXXX functions, which work on single
+        # values as well as NumPy arrays
+        count = len(data) // 2
+
+        if numpy is not None:
+            bits = numpy.frombuffer(data, '<u2', count).astype(numpy.int32)
+            ret = numpy.empty((count, 4), dtype=numpy.uint8)
+            for channel, values in enumerate(rgba(bits)):
+                ret[:, channel] = values
+            return ImageDecoder._to_size(ret.tobytes(), width, height)
+
+        table = ImageDecoder._tables16.get(rgba)
+        if table is None:
+            table = [bytes(rgba(bits)) for bits in range(0x10000)]
+            ImageDecoder._tables16[rgba] = table
+
+        return ImageDecoder._to_size(
+            b''.join([table[bits] for bits in unpack_from("<%dH" % count, data)]),
+            width, height
+        )
 
-        for i in range(0, len(data), 2):
-            color = unpack_from("<H", data, i)[0]
-            r, g, b = ImageDecoder._decode565(color)
-            ret[pos:pos+4] = r, g, b, 0xff
-            pos += 4
-        return bytes(ret)
+    @staticmethod
+    def _pal8(data, palette, width, height, alpha):
+        data = bytes(data)
+        palette = bytes(palette).ljust(1024, b'\0')
+
+        ret = bytearray(4 * len(data))
+        for channel in range(4):
+            if channel == 3 and not alpha:
+                ret[3::4] = b'\xff' * len(data)
+            else:
+                ret[channel::4] = data.translate(palette[channel::4])
+
+        return ImageDecoder._to_size(ret, width, height)
+
+    @staticmethod
+    def _pal4(data, palette, width, height, alpha):
+        data = bytes(data)
+        palette = bytes(palette).ljust(64, b'\0')
+
+        # Each byte holds two pixels, high nibble first
+        ret = bytearray(8 * len(data))
+        for channel in range(4):
+            if channel == 3 and not alpha:
+                ret[3::4] = b'\xff' * (2 * len(data))
+                continue
+
+            values = palette[channel:64:4]
+            ret[channel::8] = data.translate(bytes(values[i >> 4] for i in range(256)))
+            ret[channel+4::8] = data.translate(bytes(values[i & 0xf] for i in range(256)))
+
+        return ImageDecoder._to_size(ret, width, height)
+
+    @staticmethod
+    def bgra1555(data, width, height):
+        return ImageDecoder._convert16(data, width, height, ImageDecoder._rgba1555)
+
+    @staticmethod
+    def bgra4444(data, width, height):
+        return ImageDecoder._convert16(data, width, height, ImageDecoder._rgba4444)
+
+    @staticmethod
+    def bgra555(data, width, height):
+        return ImageDecoder._convert16(data, width, height, ImageDecoder._rgba555)
+
+    @staticmethod
+    def bgra565(data, width, height):
+        return ImageDecoder._convert16(data, width, height, ImageDecoder._rgba565)
 
     @staticmethod
     def bgra888(data, width, height):
-        ret = bytearray(4 * width * height)
-        for i in range(0, len(data), 4):
-            ret[i:i+4] = data[i+2], data[i+1], data[i+0], 0xff
-        return bytes(ret)
+        ret = bytearray(data)
+        ret[0::4], ret[2::4] = ret[2::4], ret[0::4]
+        ret[3::4] = b'\xff' * (len(data) // 4)
+        return ImageDecoder._to_size(ret, width, height)
 
     @staticmethod
     def bgra8888(data, width, height):
-        ret = bytearray(4 * width * height)
-        for i in range(0, len(data), 4):
-            ret[i:i+4] = data[i+2], data[i+1], data[i+0], data[i+3]
-        return bytes(ret)
+        ret = bytearray(data)
+        ret[0::4], ret[2::4] = ret[2::4], ret[0::4]
+        return ImageDecoder._to_size(ret, width, height)
 
     @staticmethod
     def lum8(data, width, height):
-        ret = bytearray(4 * width * height)
-        for i, c in enumerate(data):
-            pos = i * 4
-            ret[pos:pos+4] = c, c, c, 0xff
-        return bytes(ret)
+        ret = bytearray(4 * len(data))
+        ret[0::4] = ret[1::4] = ret[2::4] = data
+        ret[3::4] = b'\xff' * len(data)
+        return ImageDecoder._to_size(ret, width, height)
 
     @staticmethod
     def lum8a8(data, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
-
-        for i in range(0, len(data), 2):
-            c, a = data[i], data[i+1]
-            ret[pos:pos+4] = c, c, c, a
-            pos += 4
-        return bytes(ret)
+        data = bytes(data)
+        ret = bytearray(2 * len(data))
+        ret[0::4] = ret[1::4] = ret[2::4] = data[0::2]
+        ret[3::4] = data[1::2]
+        return ImageDecoder._to_size(ret, width, height)
 
     @staticmethod
     def pal4(data, palette, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
+        return ImageDecoder._pal4(data, palette, width, height, True)
 
-        for i in data:
-            idx1, idx2 = (i >> 4) & 0xf, i & 0xf
-            ret[pos+0:pos+4] = palette[idx1*4:idx1*4+4]
-            ret[pos+4:pos+8] = palette[idx2*4:idx2*4+4]
-            pos += 8
+    @staticmethod
+    def pal4_noalpha(data, palette, width, height):
+        return ImageDecoder._pal4(data, palette, width, height, False)
 
-        return bytes(ret)
+    @staticmethod
+    def pal8(data, palette, width, height):
+        return ImageDecoder._pal8(data, palette, width, height, True)
 
     @staticmethod
-    def pal4_noalpha(data, palette, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
+    def pal8_noalpha(data, palette, width, height):
+        return ImageDecoder._pal8(data, palette, width, height, False)
 
-        for i in data:
-            idx1, idx2 = (i >> 4) & 0xf, i & 0xf
-            ret[pos+0:pos+4] = palette[idx1*4:idx1*4+3] + b'\xff'
-            ret[pos+4:pos+8] = palette[idx2*4:idx2*4+3] + b'\xff'
-            pos += 8
+#######################################################
+class MipLevels:
 
-        return bytes(ret)
+    # Pixel data of the mip levels of a texture read from a file. Only the
+    # offset and size of each level in the texture buffer are kept; a level
+    # is copied out, and passed through decode (e.g. unswizzled), on first
+    # access.
 
-    @staticmethod
-    def pal8(data, palette, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
+    #######################################################
+    def __init__(self, data, decode=None):
+        self.data = data
+        self.decode = decode
+        self.ranges = []
+        self.levels = []
+
+    #######################################################
+    def add(self, offset, size):
+        self.ranges.append((offset, size))
+        self.levels.append(None)
 
-        for idx in data:
-            ret[pos:pos+4] = palette[idx*4:idx*4+4]
-            pos += 4
+    #######################################################
+    def __getitem__(self, level):
+        pixels = self.levels[level]
 
-        return bytes(ret)
+        if pixels is None:
+            offset, size = self.ranges[level]
+            pixels = bytes(self.data[offset:offset+size])
+            if self.decode:
+                pixels = self.decode(pixels, level)
+            self.levels[level] = pixels
 
-    @staticmethod
-    def pal8_noalpha(data, palette, width, height):
-        pos = 0
-        ret = bytearray(4 * width * height)
+        return pixels
 
-        for idx in data:
-            ret[pos:pos+4] = palette[idx*4:idx*4+3] + b'\xff'
-            pos += 4
+    #######################################################
+    def __len__(self):
+        return len(self.ranges)
 
-        return bytes(ret)
+    #######################################################
+    def __iter__(self):
+        return (self[level] for level in range(len(self.ranges)))
 
 #######################################################
 class TextureNative:
@@ -612,13 +1069,13 @@ class TextureNative:
 
         if palette_format != PaletteType.PALETTE_NONE:
             if palette_format == PaletteType.PALETTE_8:
-                return data[offset:offset+1024]
+                return bytes(data[offset:offset+1024])
 
             else:
                 if self.depth == 4:
-                    return data[offset:offset+64]
+                    return bytes(data[offset:offset+64])
 
-                return data[offset:offset+128]
+                return bytes(data[offset:offset+128])
 
         return b''
 
@@ -691,11 +1148,11 @@ class TextureNative:
         self.palette = self.read_palette(data, pos)
         pos += len(self.palette)
 
-        self.pixels = []
+        self.pixels = MipLevels(data)
         for _ in range(self.num_levels):
-            pixels = self.read_pixels(data, pos)
-            self.pixels.append(pixels)
-            pos += 4 + len(pixels)
+            pixels_len = unpack_from("<I", data, pos)[0]
+            self.pixels.add(pos + 4, pixels_len)
+            pos += 4 + pixels_len
 
         return self
 
@@ -816,6 +1273,9 @@ class txd:
     #######################################################
     def read_texture_native(self, parent_chunk):
 
+        # Textures keep views into the file buffer and only copy out the
+        # mip levels they decode
+        data = memoryview(self.data)
         chunk_end = self.pos + parent_chunk.size
 
         while self.pos < chunk_end:
@@ -829,39 +1289,39 @@ class txd:
                 if self.device_id == DeviceType.DEVICE_NONE:
                     if platform_id in (NativePlatformType.D3D8, NativePlatformType.D3D9):
                         texture = TextureNative.from_mem(
-                                self.data[self.pos:self.pos+chunk.size]
+                                data[self.pos:self.pos+chunk.size]
                         )
                     elif platform_id == NativePlatformType.PS2FOURCC:
                         from .native_ps2 import NativePS2Texture
-                        texture = NativePS2Texture.from_mem(self.data[self.pos:])
+                        texture = NativePS2Texture.from_mem(data[self.pos:])
                         self._read(texture.pos - chunk.size)
                     elif platform_id == NativePlatformType.XBOX:
                         from .native_xbox import NativeXboxTexture
-                        texture = NativeXboxTexture.from_mem(self.data[self.pos:])
+                        texture = NativeXboxTexture.from_mem(data[self.pos:])
                         self._read(texture.pos - chunk.size)
                     elif (platform_id >> 24) == NativePlatformType.GC:
                         from .native_gc import NativeGCTexture
-                        texture = NativeGCTexture.from_mem(self.data[self.pos:], self.rw_version)
+                        texture = NativeGCTexture.from_mem(data[self.pos:], self.rw_version)
                         self._read(texture.pos - chunk.size)
 
                 elif self.device_id in (DeviceType.DEVICE_D3D8, DeviceType.DEVICE_D3D9):
                     texture = TextureNative.from_mem(
-                            self.data[self.pos:self.pos+chunk.size]
+                            data[self.pos:self.pos+chunk.size]
                     )
 
                 elif self.device_id == DeviceType.DEVICE_PS2:
                     from .native_ps2 import NativePS2Texture
-                    texture = NativePS2Texture.from_mem(self.data[self.pos:])
+                    texture = NativePS2Texture.from_mem(data[self.pos:])
                     self._read(texture.pos - chunk.size)
 
                 elif self.device_id == DeviceType.DEVICE_GC:
                     from .native_gc import NativeGCTexture
-                    texture = NativeGCTexture.from_mem(self.data[self.pos:], self.rw_version)
+                    texture = NativeGCTexture.from_mem(data[self.pos:], self.rw_version)
                     self._read(texture.pos - chunk.size)
 
                 elif self.device_id == DeviceType.DEVICE_PSP:
                     from .native_psp import NativePSPTexture
-                    texture = NativePSPTexture.from_mem(self.data[self.pos:])
+                    texture = NativePSPTexture.from_mem(data[self.pos:])
                     self._read(texture.pos - chunk.size)
 
                 if texture:
@@ -998,6 +1458,31 @@ class txd:
         elif chunk.type == types["PI Texture Dictionary"]:
             self.read_pi_texture_dictionary(chunk)
 
+    #######################################################
+    def seek_chunk(self, entry):
+
+        # Jumps to a chunk from a gtaLib.toc index and reads its header
+        self.pos = entry.offset
+        return self.read_chunk()
+
+    #######################################################
+    def load_toc(self, data, index):
+
+        # Reads the texture natives using a gtaLib.toc index of the data
+        if not index.entries or index.entries[0].type != types["Texture Dictionary"]:
+            self.load_memory(data)
+            return
+
+        self.data = data
+        self.rw_version = index.entries[0].rw_version
+
+        for entry in index.find_all(types["Struct"], 0)[:1]:
+            self.seek_chunk(entry)
+            self.device_id = Sections.read(TexDict, self.data, self.pos).device_id
+
+        for entry in index.find_all(types["Texture Native"], 0):
+            self.read_texture_native(self.seek_chunk(entry))
+
     #######################################################
     def clear(self):
         self.native_textures = []
@@ -1039,9 +1524,9 @@ class txd:
     def write_memory(self, version):
 
         data = bytearray()
-        Sections.set_library_id(version, 0xFFFF)
 
-        data += self.write_texture_dictionary()
+        with WriterContext(version):
+            data += self.write_texture_dictionary()
 
         return data
 
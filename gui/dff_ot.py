@@ -5,6 +5,7 @@ import time
 
 from ..ops import dff_exporter, dff_importer, col_importer, txd_importer
 from ..ops.state import State
+from ..ops.texture_cache import TextureCache
 
 #######################################################
 class EXPORT_OT_dff(bpy.types.Operator, ExportHelper):
@@ -278,6 +279,12 @@ class IMPORT_OT_dff(bpy.types.Operator, ImportHelper):
         default     = True
     )
 
+    txd_cache : bpy.props.BoolProperty(
+        name        = "Cache Decoded Textures",
+        description = "Keep decoded textures in a cache on disk to speed up later imports",
+        default     = False
+    )
+
     txd_apply_to_objects : bpy.props.BoolProperty(
         name        = "Apply To Objects",
         description = "Apply to objects with missing textures in the scene",
@@ -362,6 +369,7 @@ class IMPORT_OT_dff(bpy.types.Operator, ImportHelper):
         box_txd.label(text="TXD")
         box_txd.prop(self, "txd_skip_mipmaps")
         box_txd.prop(self, "txd_pack")
+        box_txd.prop(self, "txd_cache")
         box_txd.prop(self, "txd_apply_to_objects")
 
         box_dff = layout.box()
@@ -395,10 +403,14 @@ class IMPORT_OT_dff(bpy.types.Operator, ImportHelper):
                         'file_name'      : file,
                         'skip_mipmaps'   : self.txd_skip_mipmaps,
                         'pack'           : self.txd_pack,
+                        'use_cache'      : self.txd_cache,
                     }
                 )
                 txd_images.update(txd.images)
 
+        if self.txd_cache:
+            TextureCache().trim()
+
         # Apply TXD images to scene objects
         if self.txd_apply_to_objects:
             for obj in context.scene.objects:
@@ -706,12 +718,43 @@ class EXPORT_OT_txd(bpy.types.Operator, ExportHelper):
         default         = True
     )
 
+    texture_format      : bpy.props.EnumProperty(
+        items =
+        (
+            ('NONE', "Uncompressed", "32 bit BGRA8888 rasters"),
+            ('AUTO', "Auto DXT", "DXT1 for opaque and one bit alpha textures, DXT5 otherwise"),
+            ('DXT1', "DXT1", "DXT1 compression, one bit alpha"),
+            ('DXT3', "DXT3", "DXT3 compression, explicit 4 bit alpha"),
+            ('DXT5', "DXT5", "DXT5 compression, interpolated alpha"),
+            ('PAL8', "PAL8", "8 bit palette (256 colors)"),
+            ('PAL4', "PAL4", "4 bit palette (16 colors)")
+        ),
+        name            = "Texture Format",
+        description     = "Raster format of the exported textures"
+    )
+
+    generate_mipmaps    : bpy.props.BoolProperty(
+        name            = "Generate Mipmaps",
+        description     = "Export the full mipmap chain of each texture",
+        default         = False
+    )
+
+    dither              : bpy.props.BoolProperty(
+        name            = "Dither",
+        description     = "Apply ordered dithering to paletted textures",
+        default         = False
+    )
+
     #######################################################
     def draw(self, context):
         layout = self.layout
 
         layout.prop(self, "mass_export")
         layout.prop(self, "only_used_textures")
+        layout.prop(self, "texture_format")
+        layout.prop(self, "generate_mipmaps")
+        if self.texture_format in ('PAL8', 'PAL4'):
+            layout.prop(self, "dither")
 
         return None
 
@@ -726,6 +769,9 @@ class EXPORT_OT_txd(bpy.types.Operator, ExportHelper):
                     "directory"          : self.directory,
                     "mass_export"        : self.mass_export,
                     "only_used_textures" : self.only_used_textures,
+                    "texture_format"     : self.texture_format,
+                    "generate_mipmaps"   : self.generate_mipmaps,
+                    "dither"             : self.dither,
                     "version"            : 0x36003, # TODO: more versions support
                 }
             )
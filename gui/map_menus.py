@@ -105,6 +105,12 @@ class DFFSceneProps(bpy.types.PropertyGroup):
         default     = False
     )
 
+    read_from_img: bpy.props.BoolProperty(
+        name        = "Read From IMG",
+        description = "Read models, textures and collisions missing from the Dff folder from models/gta3.img",
+        default     = True
+    )
+
     load_txd: bpy.props.BoolProperty(
         name        = "Load TXD files",
         default     = False
@@ -116,6 +122,12 @@ class DFFSceneProps(bpy.types.PropertyGroup):
         default     = True
     )
 
+    txd_cache : bpy.props.BoolProperty(
+        name        = "Cache Decoded Textures",
+        description = "Keep decoded textures in a cache on disk to speed up later imports",
+        default     = False
+    )
+
     read_mat_split  :  bpy.props.BoolProperty(
         name        = "Read Material Split",
         description = "Whether to read material split for loading triangles",
@@ -261,10 +273,13 @@ class MapImportPanel(bpy.types.Panel):
         col.prop(settings, "use_custom_map_section")
         col.separator()
 
+        col.prop(settings, "read_from_img")
+
         box = col.box()
         box.prop(settings, "load_txd")
         if settings.load_txd:
             box.prop(settings, "txd_pack")
+            box.prop(settings, "txd_cache")
 
         col.prop(settings, "skip_lod")
         col.prop(settings, "read_mat_split")
@@ -166,6 +166,10 @@ class SCENE_OT_dff_import_map(bpy.types.Operator):
         wm.progress_end()
         wm.event_timer_remove(self._timer)
 
+        if self._importer:
+            self._importer.shutdown_prefetch()
+            self._importer.close_files()
+
 #######################################################
 class SCENE_OT_ipl_select(bpy.types.Operator, ImportHelper):
 
@@ -21,6 +21,8 @@ import math
 import mathutils
 
 from collections import OrderedDict
+from itertools import chain
+from operator import itemgetter
 
 from ..gtaLib import dff
 from .importer_common import (
@@ -31,6 +33,12 @@ from .col_importer import import_col_mem
 from ..ops.ext_2dfx_importer import ext_2dfx_importer
 from ..ops.state import State
 
+# Mesh data is gathered through NumPy when it's there, lists otherwise
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 #######################################################
 class dff_importer:
 
@@ -109,6 +117,235 @@ class dff_importer:
                             check_existing=True
                             )
 
+    #######################################################
+    def filter_faces(faces, verts_num, has_normals):
+
+        # Works on vertex indices only, before any mesh data is created.
+        # Returns indices of the faces to create, the positions (in that
+        # list) of faces that had a double, the number of skipped double
+        # faces and the number of faces with out of range vertex indices.
+        last_face_index = len(faces) - 1
+        skipped_double_faces_num = 0
+        invalid_faces_num = 0
+        face_map = {}
+        double_faces = set()
+        face_indices = []
+
+        for fi, f in enumerate(faces):
+            vert_indices = (f.a, f.b, f.c)
+
+            # Skip a face referencing vertices that don't exist
+            if max(vert_indices) >= verts_num:
+                invalid_faces_num += 1
+                continue
+
+            # Skip a face with less than 3 vertices
+            if len(set(vert_indices)) < 3:
+                continue
+
+            # Skip double face (keep the last one)
+            # has_normals only
+            if has_normals and fi < last_face_index:
+                next_face = faces[fi + 1]
+                if set(vert_indices) == set((next_face.a, next_face.b, next_face.c)):
+                    skipped_double_faces_num += 1
+                    continue
+
+            # Skip already created face
+            face_key = tuple(sorted(vert_indices))
+            if face_key in face_map:
+
+                # Store double faces for normal calculation
+                if not has_normals:
+                    double_faces.add(face_map[face_key])
+
+                skipped_double_faces_num += 1
+                continue
+
+            face_map[face_key] = len(face_indices)
+            face_indices.append(fi)
+
+        return face_indices, sorted(double_faces), skipped_double_faces_num, invalid_faces_num
+
+    #######################################################
+    def flatten(items):
+
+        # Flat sequence of the components of a list of namedtuples
+        if isinstance(items, dff.PackedList):
+            return items.array
+
+        return list(chain.from_iterable(items))
+
+    #######################################################
+    def gather(items, indices):
+
+        # items[i] for each i in indices, in a single pass
+        if not indices:
+            return ()
+        if len(indices) == 1:
+            return (items[indices[0]],)
+
+        return itemgetter(*indices)(items)
+
+    #######################################################
+    def create_mesh_data(mesh, geom, faces, face_indices, backfaces, mat_indices,
+                         use_face_loops, use_custom_normals):
+
+        # Fills the mesh with foreach_set from flat buffers instead of
+        # going through bmesh one vertex and one loop at a time. Backfaces
+        # (positions in face_indices) are added after all the other faces,
+        # as copies with the winding reversed.
+        self = dff_importer
+
+        poly_faces = face_indices + [face_indices[i] for i in backfaces]
+        polys_num = len(poly_faces)
+        loops_num = polys_num * 3
+
+        loop_verts = []
+        for fi in face_indices:
+            f = faces[fi]
+            loop_verts += (f.a, f.b, f.c)
+        for i in backfaces:
+            f = faces[face_indices[i]]
+            loop_verts += (f.a, f.c, f.b)
+
+        # Index of the vertex data (uvs, colours, normals) for each loop
+        if use_face_loops:
+            loop_data = [fi * 3 + i for fi in face_indices for i in range(3)]
+            loop_data += [face_indices[i] * 3 + j for i in backfaces for j in (0, 2, 1)]
+        else:
+            loop_data = loop_verts
+
+        mesh.vertices.add(len(geom.vertices))
+        mesh.vertices.foreach_set("co", self.flatten(geom.vertices))
+
+        mesh.loops.add(loops_num)
+        mesh.loops.foreach_set("vertex_index", loop_verts)
+
+        mesh.polygons.add(polys_num)
+        mesh.polygons.foreach_set("loop_start", list(range(0, loops_num, 3)))
+        mesh.polygons.foreach_set("loop_total", [3] * polys_num)
+        mesh.polygons.foreach_set("use_smooth", [True] * polys_num)
+
+        if len(mat_indices) > 0:
+            mesh.polygons.foreach_set(
+                "material_index",
+                [mat_indices[faces[fi].material] for fi in poly_faces]
+            )
+
+        if backfaces and bpy.app.version >= (4, 4, 0):
+            attribute = mesh.attributes.new("backface", 'BOOLEAN', 'FACE')
+            attribute.data.foreach_set(
+                "value", [False] * len(face_indices) + [True] * len(backfaces)
+            )
+
+        if numpy is not None:
+            loop_data_array = numpy.array(loop_data, dtype=numpy.intp)
+
+        # Setting UV coordinates, Y coords are flipped in Blender
+        for layer in geom.uv_layers:
+            coords = self.flatten(layer)
+
+            if numpy is not None:
+                uvs = numpy.asarray(coords, dtype=numpy.float32).reshape(-1, 2)[loop_data_array]
+                uvs[:, 1] = 1 - uvs[:, 1]
+                uvs = uvs.ravel()
+            else:
+                pairs = list(zip(coords[0::2], [1 - v for v in coords[1::2]]))
+                uvs = list(chain.from_iterable(self.gather(pairs, loop_data)))
+
+            uv_layer = mesh.uv_layers.new(do_init=False)
+            uv_layer.data.foreach_set("uv", uvs)
+
+        # Vertex colors, then Night/Extra Vertex Colors
+        color_layers = []
+        if geom.flags & dff.rpGEOMETRYPRELIT:
+            color_layers.append(geom.prelit_colors)
+        if 'extra_vert_color' in geom.extensions:
+            color_layers.append(geom.extensions['extra_vert_color'].colors)
+
+        # Byte colour attributes only take sRGB values through color_srgb,
+        # without it the colours go to the (sRGB) vertex_colors layers
+        byte_color = getattr(bpy.types, 'ByteColorAttributeValue', None)
+        use_color_attributes = byte_color is not None and \
+            'color_srgb' in byte_color.bl_rna.properties
+
+        for colors in color_layers:
+            colors = self.flatten(colors)
+
+            if numpy is not None:
+                loop_colors = numpy.asarray(colors, dtype=numpy.float32).reshape(-1, 4)[loop_data_array]
+                loop_colors = (loop_colors / 255.0).ravel()
+            else:
+                colors = [c / 255.0 for c in colors]
+                colors = list(zip(colors[0::4], colors[1::4], colors[2::4], colors[3::4]))
+                loop_colors = list(chain.from_iterable(self.gather(colors, loop_data)))
+
+            if use_color_attributes:
+                attribute = mesh.color_attributes.new("Col", 'BYTE_COLOR', 'CORNER')
+                attribute.data.foreach_set("color_srgb", loop_colors)
+            else:
+                layer = mesh.vertex_colors.new(name="Col")
+                layer.data.foreach_set("color", loop_colors)
+
+        mesh.update(calc_edges=True)
+
+        # Normals
+        if use_custom_normals:
+            return list(self.gather(list(geom.normals), loop_data))
+
+        return []
+
+    #######################################################
+    def fix_double_faces(mesh, double_faces, backfaces_start):
+
+        # Flips double faces that disagree with the faces around them. The
+        # flips are worked out on a copy without the backfaces (appended from
+        # backfaces_start in double_faces order), each of which is flipped
+        # along with its face.
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+        bm.faces.ensure_lookup_table()
+        bm.normal_update()
+
+        bm_work = bm.copy()
+        if backfaces_start is not None:
+            bm_work.faces.ensure_lookup_table()
+            bmesh.ops.delete(bm_work, geom=bm_work.faces[backfaces_start:], context='FACES_ONLY')
+        bm_work.faces.ensure_lookup_table()
+
+        work_faces = [bm_work.faces[i] for i in double_faces]
+
+        # Calculate normals
+        bmesh.ops.recalc_face_normals(bm_work, faces=work_faces)
+
+        bm_welded = bm_work.copy()
+        bm_welded.faces.ensure_lookup_table()
+        face_pairs = [(face, bm_welded.faces[face.index]) for face in work_faces]
+
+        bmesh.ops.remove_doubles(bm_welded, verts=bm_welded.verts, dist=0.0001)
+        bmesh.ops.recalc_face_normals(bm_welded, faces=bm_welded.faces)
+
+        for face, welded_face in face_pairs:
+            if welded_face.is_valid and face.normal.dot(welded_face.normal) < 0.0:
+                face.normal_flip()
+
+        bm_welded.free()
+
+        flipped = False
+        for i, (fi, face) in enumerate(zip(double_faces, work_faces)):
+            if face.normal.dot(bm.faces[fi].normal) < 0.0:
+                bm.faces[fi].normal_flip()
+                if backfaces_start is not None:
+                    bm.faces[backfaces_start + i].normal_flip()
+                flipped = True
+
+        bm_work.free()
+
+        if flipped:
+            bm.to_mesh(mesh)
+        bm.free()
+
     #######################################################
     # TODO: Cyclomatic Complexity too high
     def import_atomics():
@@ -121,7 +358,6 @@ class dff_importer:
             geom = self.dff.geometry_list[atomic.geometry]
 
             mesh = bpy.data.meshes.new(self.clean_object_name(frame.name))
-            bm   = bmesh.new()
 
             # Create a material order sorted by geometry splits
             mat_order = [split.material for split in geom.split_headers] + list(range(len(geom.materials)))
@@ -136,35 +372,13 @@ class dff_importer:
                 (geom.flags & dff.rpGEOMETRYMODULATEMATERIALCOLOR) != 0
             mesh['dragon_triangle_strip'] = (geom.flags & dff.rpGEOMETRYTRISTRIP) != 0
 
-            uv_layers = []
-            normals = []
-
-            # Vertices
-            for v in geom.vertices:
-                bm.verts.new(v)
-
-            bm.verts.ensure_lookup_table()
-            bm.verts.index_update()
-
             # Will use this later when creating frames to construct an armature
             if 'skin' in geom.extensions:
                 if atomic.frame not in self.skin_data:
                     self.skin_data[atomic.frame] = geom.extensions['skin']
                     
             if 'user_data' in geom.extensions:
-                mesh['dff_user_data'] = geom.extensions['user_data'].to_mem()[12:]
-            
-            # Add UV Layers
-            for layer in geom.uv_layers:
-                uv_layers.append(bm.loops.layers.uv.new())
-                
-            # Add Vertex Colors
-            if geom.flags & dff.rpGEOMETRYPRELIT:
-                vertex_color = bm.loops.layers.color.new()
-
-            extra_vertex_color = None
-            if 'extra_vert_color' in geom.extensions:
-                extra_vertex_color = bm.loops.layers.color.new()
+                mesh['dff_user_data'] = bytes(geom.extensions['user_data'].to_mem()[12:])
 
             if (dff_importer.use_mat_split or not geom.triangles) and 'mat_split' in geom.extensions:
                 faces = geom.extensions['mat_split']
@@ -175,131 +389,27 @@ class dff_importer:
             use_face_loops = geom.native_platform_type == dff.NativePlatformType.GC
             use_custom_normals = has_normals and self.import_normals
 
-            last_face_index = len(faces) - 1
-            skipped_double_faces_num = 0
-            face_map = {}
-            double_faces = set()
-
-            if self.create_backfaces and not has_normals:
-                if bpy.app.version >= (4, 4, 0):
-                    backface_layer = bm.faces.layers.bool.new("backface")
-                else:
-                    backface_layer = None
-
-            for fi, f in enumerate(faces):
-                vert_indices = (f.a, f.b, f.c)
-
-                # Skip a face with less than 3 vertices
-                if len(set(vert_indices)) < 3:
-                    continue
-
-                # Skip double face (keep the last one)
-                # has_normals only
-                if has_normals and fi < last_face_index:
-                    next_face = faces[fi + 1]
-                    if set(vert_indices) == set((next_face.a, next_face.b, next_face.c)):
-                        skipped_double_faces_num += 1
-                        continue
+            face_indices, double_faces, skipped_double_faces_num, invalid_faces_num = \
+                self.filter_faces(faces, len(geom.vertices), has_normals)
 
-                # Skip already created face
-                face_key = tuple(sorted(vert_indices))
-                if face_key in face_map:
+            if invalid_faces_num:
+                print('Skipped %d faces with invalid vertex indices for atomic %d' % (invalid_faces_num, atomic_index))
 
-                    # Store double faces for normal calculation
-                    if not has_normals:
-                        double_faces.add(face_map[face_key])
-
-                    skipped_double_faces_num += 1
-                    continue
-
-                try:
-                    face = bm.faces.new(
-                        [
-                            bm.verts[f.a],
-                            bm.verts[f.b],
-                            bm.verts[f.c]
-                        ])
-
-                except ValueError as e:
-                    print(e)
-                    continue
-
-                face_map[face_key] = face
-
-                if len(mat_indices) > 0:
-                    face.material_index = mat_indices[f.material]
-
-                if use_face_loops:
-                    vert_index = fi * 3
-                    vert_indices = (vert_index, vert_index + 1, vert_index + 2)
-
-                # Setting UV coordinates
-                for loop_index, loop in enumerate(face.loops):
-                    vert_index = vert_indices[loop_index]
-                    for i, layer in enumerate(geom.uv_layers):
-
-                        bl_layer = uv_layers[i]
-
-                        uv_coords = layer[vert_index]
-
-                        loop[bl_layer].uv = (
-                            uv_coords.u,
-                            1 - uv_coords.v # Y coords are flipped in Blender
-                        )
-                    # Vertex colors
-                    if geom.flags & dff.rpGEOMETRYPRELIT:
-                        loop[vertex_color] = [
-                            c / 255.0 for c in
-                            geom.prelit_colors[vert_index]
-                        ]
-                    # Night/Extra Vertex Colors
-                    if extra_vertex_color:
-                        extension = geom.extensions['extra_vert_color']
-                        loop[extra_vertex_color] = [
-                            c / 255.0 for c in
-                            extension.colors[vert_index]
-                        ]
-
-                    # Normals
-                    if use_custom_normals:
-                        normals.append(geom.normals[vert_index])
-
-                face.smooth = True
+            backfaces = double_faces if self.create_backfaces else []
+            normals = self.create_mesh_data(mesh, geom, faces, face_indices,
+                                            backfaces, mat_indices,
+                                            use_face_loops, use_custom_normals)
 
+            # Double faces need bmesh to fix up their normals
             if double_faces:
-                double_faces = list(double_faces)
-
-                # Calculate normals
-                bmesh.ops.recalc_face_normals(bm, faces=double_faces)
-
-                bm_welded = bm.copy()
-                bm_welded.faces.ensure_lookup_table()
-                face_pairs = [(face, bm_welded.faces[face.index]) for face in double_faces]
-
-                bmesh.ops.remove_doubles(bm_welded, verts=bm_welded.verts, dist=0.0001)
-                bmesh.ops.recalc_face_normals(bm_welded, faces=bm_welded.faces)
-
-                for face, welded_face in face_pairs:
-                    if welded_face.is_valid and face.normal.dot(welded_face.normal) < 0.0:
-                        face.normal_flip()
-
-                bm_welded.free()
-
-                # Create backfaces
-                if self.create_backfaces:
-                    bmesh.ops.duplicate(bm, geom=double_faces)
-                    bmesh.ops.reverse_faces(bm, faces=double_faces)
-                    if backface_layer is not None:
-                        for face in double_faces:
-                            face[backface_layer] = True
+                self.fix_double_faces(mesh, double_faces,
+                                      len(face_indices) if backfaces else None)
+                if backfaces:
                     skipped_double_faces_num = 0
 
             if skipped_double_faces_num:
                 print('Skipped %d double faces for atomic %d' % (skipped_double_faces_num, atomic_index))
 
-            bm.to_mesh(mesh)
-            bm.free()
-
             # Set loop normals
             if normals:
                 mesh.normals_split_custom_set(normals)
@@ -681,7 +791,7 @@ class dff_importer:
             e_bone['type'] = bone.type
 
             if bone_frame.user_data is not None:
-                e_bone['dff_user_data'] = bone_frame.user_data.to_mem()[12:]
+                e_bone['dff_user_data'] = bytes(bone_frame.user_data.to_mem()[12:])
 
             if skinned_obj_data is not None:
                 matrix = skinned_obj_data.bone_matrices[bone.index]
@@ -985,7 +1095,7 @@ class dff_importer:
             self.objects[index] = obj
 
             if frame.user_data is not None:
-                obj["dff_user_data"] = frame.user_data.to_mem()[12:]
+                obj["dff_user_data"] = bytes(frame.user_data.to_mem()[12:])
 
         if self.remove_doubles:
             self.remove_object_doubles()
@@ -1000,13 +1110,16 @@ class dff_importer:
             link_object(obj, self.current_collection)
 
     #######################################################
-    def import_dff(file_name):
+    def import_dff(file_name, dff_file=None):
         self = dff_importer
         self._init()
 
-        # Load the DFF
-        self.dff = dff.dff()
-        self.dff.load_file(file_name)
+        # Load the DFF, unless it was already parsed elsewhere
+        if dff_file is None:
+            dff_file = dff.dff()
+            dff_file.load_file(file_name)
+
+        self.dff = dff_file
         self.file_name = file_name
 
         # Create a new group/collection
@@ -1094,6 +1207,6 @@ def import_dff(options):
     dff_importer.import_breakable  = options.get('import_breakable', True)
     dff_importer.hide_damage_parts = options.get('hide_damage_parts', False)
 
-    dff_importer.import_dff(options['file_name'])
+    dff_importer.import_dff(options['file_name'], options.get('dff'))
 
     return dff_importer
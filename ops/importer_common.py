@@ -259,7 +259,7 @@ class material_helper:
 
     #######################################################
     def set_user_data(self, user_data):
-        self.material['dff_user_data'] = user_data.to_mem()[12:]
+        self.material['dff_user_data'] = bytes(user_data.to_mem()[12:])
         
     #######################################################
     def __init__(self, material):
@@ -15,10 +15,18 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import bpy
+import multiprocessing
 import os
+import runpy
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from ..gtaLib import map as map_utilites
+from ..gtaLib.img import img
 from ..ops import dff_importer, col_importer, txd_importer
+from .map_prefetch import close_archives, decode_txd, parse_dff, read_file
 from .cull_importer import cull_importer
+from .texture_cache import TextureCache
 from .importer_common import hide_object
 
 #######################################################
@@ -35,6 +43,15 @@ class map_importer:
     cull_collection = None
     map_section = ""
     settings = None
+    executor = None
+    dff_futures = {}
+    txd_futures = {}
+    prefetch_queue = {}
+    prefetch_window = 16
+    txd_cache = {}
+    img_file = None
+    loose_files = {}
+    texture_cache = None
 
     #######################################################
     @staticmethod
@@ -121,8 +138,8 @@ class map_importer:
             dff_filename = "%s.dff" % model
             txd_filename = "%s.txd" % txd
 
-            dff_filepath = map_utilites.MapDataUtility.find_path_case_insensitive(self.settings.dff_folder, dff_filename)
-            txd_filepath = map_utilites.MapDataUtility.find_path_case_insensitive(self.settings.dff_folder, txd_filename)
+            dff_filepath, dff_entry = self.find_file(dff_filename)
+            txd_filepath, txd_entry = self.find_file(txd_filename)
 
             # Import dff from a file if file exists
             if not dff_filepath:
@@ -131,22 +148,39 @@ class map_importer:
 
             txd_images = {}
             if self.settings.load_txd:
-                if txd_filepath:
+                if txd_filepath in self.txd_cache:
+                    txd_images = self.txd_cache[txd_filepath]
+                elif txd_filepath:
+                    textures = self.get_prefetched(self.txd_futures, txd_filepath)
+                    if textures is None and txd_entry is not None:
+                        textures = decode_txd(
+                            txd_filepath, self.img_path(), txd_entry,
+                            self.texture_cache
+                        )
+
                     txd_images = txd_importer.import_txd(
                         {
                             'file_name'      : txd_filepath,
                             'skip_mipmaps'   : True,
                             'pack'           : self.settings.txd_pack,
+                            'use_cache'      : self.settings.txd_cache,
+                            'textures'       : textures,
                         }
                     ).images
+                    self.txd_cache[txd_filepath] = txd_images
                 else:
                     print("TXD not found:", os.path.join(self.settings.dff_folder, txd_filename))
 
+            dff_file = self.get_prefetched(self.dff_futures, dff_filepath)
+            if dff_file is None:
+                dff_file = parse_dff(dff_filepath, self.img_path(), dff_entry)
+
+            # The file is already parsed. file_name keeps the IDE model name,
+            # which names the collection that cached instances and collision
+            # meshes are linked to, whatever the case of the file or entry.
             importer = dff_importer.import_dff(
                 {
-                    'file_name'      : "%s/%s.dff" % (
-                        self.settings.dff_folder, model
-                    ),
+                    'file_name'        : os.path.join(self.settings.dff_folder, dff_filename),
                     'txd_images'       : txd_images,
                     'image_ext'        : 'PNG',
                     'connect_bones'    : False,
@@ -157,6 +191,7 @@ class map_importer:
                     'import_normals'   : True,
                     'materials_naming' : "DEF",
                     'import_breakable' : self.settings.import_breakable,
+                    'dff'              : dff_file,
                 }
             )
 
@@ -204,6 +239,196 @@ class map_importer:
                     )
                 hide_object(new_obj)
 
+    #######################################################
+    @staticmethod
+    def prefetch_files():
+        self = map_importer
+
+        self.dff_futures = {}
+        self.txd_futures = {}
+        self.prefetch_queue = {}
+
+        # Queue in instance order, so the first files imported are ready first
+        for inst in self.object_instances:
+            if hasattr(inst, 'lod') and int(inst.lod) == -1 and self.settings.skip_lod:
+                continue
+
+            if inst.id not in self.object_data:
+                continue
+
+            objdata = self.object_data[inst.id]
+            dff_filepath, dff_entry = self.find_file("%s.dff" % objdata.modelName)
+            if not dff_filepath or dff_filepath in self.prefetch_queue:
+                continue
+
+            if self.settings.load_txd:
+                txd_filepath, txd_entry = self.find_file("%s.txd" % objdata.txdName)
+                if txd_filepath and txd_filepath not in self.prefetch_queue:
+                    self.prefetch_queue[txd_filepath] = (
+                        self.txd_futures, decode_txd,
+                        (txd_filepath, self.img_path(), txd_entry, self.texture_cache)
+                    )
+
+            self.prefetch_queue[dff_filepath] = (
+                self.dff_futures, parse_dff,
+                (dff_filepath, self.img_path(), dff_entry)
+            )
+
+        if self.prefetch_queue:
+            self.executor = self.create_executor()
+
+        self.submit_prefetch()
+
+    #######################################################
+    @staticmethod
+    def submit_prefetch():
+        self = map_importer
+
+        # Keeps at most prefetch_window files parsed or being parsed ahead
+        # of the import, so memory use doesn't grow with the map size
+        if not self.executor:
+            return
+
+        while self.prefetch_queue and \
+                len(self.dff_futures) + len(self.txd_futures) < self.prefetch_window:
+            filename = next(iter(self.prefetch_queue))
+            futures, function, args = self.prefetch_queue.pop(filename)
+            futures[filename] = self.executor.submit(function, *args)
+
+    #######################################################
+    @staticmethod
+    def create_executor():
+
+        # Parsing is pure Python, so it only runs in parallel in separate
+        # processes. Forking Blender isn't safe, and its own binary can't run
+        # them, so workers are spawned with the bundled Python interpreter
+        # (sys.executable since Blender 2.91) and only import gtaLib.
+        if not os.path.basename(sys.executable).lower().startswith('python'):
+            return None
+
+        ops_path = os.path.dirname(os.path.abspath(__file__))
+        init_globals = {
+            'package_name' : __package__.rpartition('.')[0],
+            'package_path' : os.path.dirname(ops_path),
+        }
+
+        return ProcessPoolExecutor(
+            max_workers=max(1, min(8, (os.cpu_count() or 1) - 1)),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=runpy.run_path,
+            initargs=(os.path.join(ops_path, 'map_prefetch_init.py'), init_globals),
+        )
+
+    #######################################################
+    @staticmethod
+    def get_prefetched(futures, filename):
+        self = map_importer
+
+        # A file still queued is parsed on import instead, it must not
+        # take a place in the window later
+        self.prefetch_queue.pop(filename, None)
+
+        future = futures.pop(filename, None)
+        self.submit_prefetch()
+
+        if future is None:
+            return None
+
+        # Fall back to parsing on the main thread if the worker failed
+        try:
+            return future.result()
+        except Exception as e:
+            print("Prefetching %s failed:" % filename, e)
+            return None
+
+    #######################################################
+    @staticmethod
+    def shutdown_prefetch():
+        self = map_importer
+
+        # Queued files are dropped, the ones being read are waited for so
+        # that the archive can be closed after this
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+        self.dff_futures = {}
+        self.txd_futures = {}
+        self.prefetch_queue = {}
+        self.txd_cache = {}
+
+    #######################################################
+    @staticmethod
+    def open_files():
+        self = map_importer
+
+        self.texture_cache = TextureCache() if self.settings.txd_cache else None
+
+        # Loose files in the DFF folder by lowercase name, listed once.
+        # They override entries of the IMG archive.
+        self.loose_files = {}
+        try:
+            for filename in os.listdir(self.settings.dff_folder):
+                self.loose_files.setdefault(
+                    filename.lower(), os.path.join(self.settings.dff_folder, filename)
+                )
+        except OSError:
+            print("Warning: DFF folder not found:", self.settings.dff_folder)
+
+        if self.settings.read_from_img:
+            img_path = os.path.join(self.settings.game_root, 'models/gta3.img')
+            # Either gta3.img or, for III and VC, gta3.dir can be missing.
+            # The import then goes on with the loose files only.
+            try:
+                self.img_file = img.open(img_path)
+            except FileNotFoundError as e:
+                print("Warning: %s not found at:" % os.path.basename(e.filename), e.filename)
+            except (OSError, struct.error) as e:
+                print("Warning: failed to read %s:" % img_path, e)
+
+    #######################################################
+    @staticmethod
+    def close_files():
+        self = map_importer
+
+        # Evict old texture cache entries once, at the end of the import
+        if self.texture_cache:
+            self.texture_cache.trim()
+            self.texture_cache = None
+
+        if self.img_file:
+            self.img_file.close()
+            self.img_file = None
+
+        close_archives()
+        self.loose_files = {}
+
+    #######################################################
+    @staticmethod
+    def img_path():
+        self = map_importer
+        return self.img_file.filename if self.img_file else None
+
+    #######################################################
+    @staticmethod
+    def find_file(filename):
+        self = map_importer
+
+        # Returns the path of a file and None for loose files, or the path
+        # it would have in the DFF folder and its DirectoryEntry for files in
+        # the IMG archive. (None, None) if it isn't found.
+        path = self.loose_files.get(filename.lower())
+        if path:
+            return path, None
+
+        if self.img_file:
+            entry_idx = self.img_file.find_entry_idx(filename)
+            if entry_idx > -1:
+                entry = self.img_file.directory_entries[entry_idx]
+                return os.path.join(self.settings.dff_folder, entry.name), entry
+
+        return None, None
+
     #######################################################
     @staticmethod
     def import_collision(context, filename):
@@ -214,7 +439,12 @@ class map_importer:
 
         collection = bpy.data.collections.new(filename)
         self.collision_collection.children.link(collection)
-        col_list = col_importer.import_col_file(os.path.join(self.settings.dff_folder, filename), filename)
+
+        path, entry = self.find_file(filename)
+        if entry is None:
+            col_list = col_importer.import_col_file(os.path.join(self.settings.dff_folder, filename), filename)
+        else:
+            col_list = col_importer.import_col_mem(read_file(path, self.img_path(), entry), filename)
 
         # Move all collisions to a top collection named for the file they came from
         for c in col_list:
@@ -289,6 +519,9 @@ class map_importer:
     def load_map(settings):
         self = map_importer
 
+        self.shutdown_prefetch()
+        self.close_files()
+
         self.model_cache = {}
         self.col_files = []
         self.object_instances_collection = None
@@ -317,13 +550,22 @@ class map_importer:
         else:
             self.cull_instances = []
 
+        self.open_files()
+
         if self.settings.load_collisions:
 
-            # Get a list of the .col files available
-            col_files_all = set()
-            for filename in os.listdir(self.settings.dff_folder):
-                if filename.lower().endswith(".col"):
-                    col_files_all.add(filename)
+            # Get a list of the .col files available, loose ones first
+            col_files_all = {}
+            for name, path in self.loose_files.items():
+                if name.endswith(".col"):
+                    col_files_all[name] = os.path.basename(path)
+
+            if self.img_file:
+                for entry_idx in self.img_file.find_entries_by_extension(".col"):
+                    filename = self.img_file.directory_entries[entry_idx].name
+                    col_files_all.setdefault(filename.lower(), filename)
+
+            col_files_all = set(col_files_all.values())
 
             # Run through all instances and determine which .col files to load
             for i in range(len(self.object_instances)):
@@ -342,6 +584,9 @@ class map_importer:
                         if not bpy.data.collections.get(filename) and filename not in self.col_files:
                             self.col_files.append(filename)
 
+        # Start parsing models and textures in the background
+        self.prefetch_files()
+
     #######################################################
     @staticmethod
     def apply_transformation_to_object(obj, inst):
@@ -0,0 +1,90 @@
+# GTA DragonFF - Blender scripts to edit basic GTA formats
+# Copyright (C) 2019  Parik
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+
+from ..gtaLib import dff, txd
+from ..gtaLib.img import SECTOR_SIZE
+from .texture_cache import decode_level
+
+# Map import parses DFFs and decodes TXDs ahead of time in spawned worker
+# processes. Nothing here imports bpy: workers run the plain Python
+# interpreter and only import gtaLib and this module, see
+# map_prefetch_init.py. Tasks get everything they need as arguments and
+# return parsed data that can be pickled.
+
+# Archives opened by this process, by path
+_archives = {}
+
+#######################################################
+def read_file(file_name, img_path=None, entry=None):
+
+    # entry is the DirectoryEntry of the file in the IMG archive at img_path,
+    # or None for loose files. Each process opens an archive once.
+    if entry is not None:
+        file = _archives.get(img_path)
+        if file is None:
+            file = _archives[img_path] = open(img_path, mode='rb')
+
+        file.seek(entry.offset * SECTOR_SIZE, os.SEEK_SET)
+        return file.read(entry.size * SECTOR_SIZE)
+
+    with open(file_name, mode='rb') as file:
+        return file.read()
+
+#######################################################
+def close_archives():
+    for file in _archives.values():
+        file.close()
+
+    _archives.clear()
+
+#######################################################
+def parse_dff(file_name, img_path=None, entry=None):
+    dff_file = dff.dff()
+    dff_file.load_memory(read_file(file_name, img_path, entry))
+
+    # Only send back the parsed sections, not the file contents
+    dff_file.data = b''
+
+    return dff_file
+
+#######################################################
+def decode_txd(file_name, img_path=None, entry=None, cache=None, skip_mipmaps=True):
+
+    # Returns [(texture name, [(width, height, rgba), ...]), ...]
+    data = read_file(file_name, img_path, entry)
+
+    txd_file = txd.txd()
+    txd_file.load_memory(data)
+    file_key = cache.file_key(data) if cache is not None else None
+
+    textures = []
+    for tex in txd_file.native_textures:
+        num_levels = tex.num_levels if not skip_mipmaps else 1
+        textures.append((tex.name, [
+            decode_level(tex, level, cache, file_key)
+            for level in range(num_levels)
+        ]))
+
+    for tex, imgs in zip(txd_file.textures, txd_file.images):
+        num_levels = len(imgs) if not skip_mipmaps else 1
+        textures.append((tex.name, [
+            (img.width, img.height, img.to_rgba())
+            for img in imgs[:num_levels]
+        ]))
+
+    return textures
@@ -0,0 +1,32 @@
+# GTA DragonFF - Blender scripts to edit basic GTA formats
+# Copyright (C) 2019  Parik
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Run with runpy.run_path in each map prefetch worker before its first
+# task, with package_name and package_path set. The addon package imports
+# bpy, which the plain Python interpreter of the workers doesn't have. It
+# is replaced by empty packages, so tasks can still import the gtaLib and
+# ops modules below it.
+
+import sys
+import types
+
+parts = package_name.split('.')
+for i in range(len(parts)):
+    name = '.'.join(parts[:i + 1])
+    if name not in sys.modules:
+        package = types.ModuleType(name)
+        package.__path__ = [package_path] if i == len(parts) - 1 else []
+        sys.modules[name] = package
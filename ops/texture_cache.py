@@ -0,0 +1,141 @@
+# GTA DragonFF - Blender scripts to edit basic GTA formats
+# Copyright (C) 2019  Parik
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import tempfile
+import threading
+from struct import calcsize, pack, unpack_from
+
+#######################################################
+class TextureCache:
+
+    # Decoded RGBA mip levels on disk, keyed by the hash of the TXD file
+    # contents, the texture name and the level. Each entry is one file with
+    # a small header followed by the raw pixels. Entries are touched when
+    # read, and the least recently used ones are removed once the directory
+    # grows past max_size on trim(), which scans the whole directory and is
+    # run once at the end of an import. Doesn't touch bpy, so it can be
+    # used from the map import prefetch workers.
+
+    header = "<4sII"
+    magic = b"RGBA"
+
+    #######################################################
+    def __init__(self, directory=None, max_size=1 << 30):
+        self.directory = directory or os.path.join(
+            tempfile.gettempdir(), "dragonff_textures"
+        )
+        self.max_size = max_size
+
+    #######################################################
+    @staticmethod
+    def file_key(data):
+        return hashlib.sha1(data).hexdigest()
+
+    #######################################################
+    def _path(self, key, name, level):
+        name_hash = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, "%s_%s_%d.rgba" % (key, name_hash, level))
+
+    #######################################################
+    def get(self, key, name, level):
+
+        # Returns (width, height, rgba) or None
+        path = self._path(key, name, level)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+
+        header_size = calcsize(self.header)
+        if len(data) < header_size:
+            return None
+
+        magic, width, height = unpack_from(self.header, data)
+        if magic != self.magic:
+            return None
+
+        return width, height, data[header_size:]
+
+    #######################################################
+    def put(self, key, name, level, width, height, rgba):
+        path = self._path(key, name, level)
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                file.write(pack(self.header, self.magic, width, height))
+                file.write(rgba)
+
+            # Atomic, other readers never see a partial entry
+            os.replace(tmp_path, path)
+
+        except OSError as e:
+            print("Failed to write texture cache entry:", e)
+
+    #######################################################
+    def trim(self):
+
+        try:
+            entries = [
+                entry for entry in os.scandir(self.directory)
+                if entry.name.endswith(".rgba")
+            ]
+        except OSError:
+            return
+
+        stats = []
+        for entry in entries:
+            try:
+                stats.append((entry.stat(), entry.path))
+            except OSError:
+                pass
+
+        total_size = sum(stat.st_size for stat, _ in stats)
+        if total_size <= self.max_size:
+            return
+
+        # Least recently used first
+        stats.sort(key=lambda item: item[0].st_mtime)
+        for stat, path in stats:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= stat.st_size
+
+#######################################################
+def decode_level(tex, level, cache=None, file_key=None):
+
+    # (width, height, rgba) of a native texture level, from the cache if it
+    # has been decoded before
+    if cache is not None:
+        decoded = cache.get(file_key, tex.name, level)
+        if decoded is not None:
+            return decoded
+
+    decoded = (tex.get_width(level), tex.get_height(level), tex.to_rgba(level))
+
+    if cache is not None:
+        cache.put(file_key, tex.name, level, *decoded)
+
+    return decoded
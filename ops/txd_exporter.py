@@ -16,19 +16,41 @@
 
 import bpy
 import os
+from array import array
 
 from .exporter_common import (
     clear_extension, extract_texture_info_from_name)
 
 from ..gtaLib import txd
-from ..gtaLib.txd import ImageEncoder
+from ..gtaLib.txd import ImageEncoder, numpy
 from ..gtaLib.dff import NativePlatformType
 
+# Raster format, D3D format and depth of each export texture format
+texture_formats = {
+    'NONE' : (txd.RasterFormat.RASTER_8888, txd.D3DFormat.D3D_8888, 32),
+    'DXT1' : (txd.RasterFormat.RASTER_565,  txd.D3DFormat.D3D_DXT1, 16),
+    'DXT3' : (txd.RasterFormat.RASTER_4444, txd.D3DFormat.D3D_DXT3, 16),
+    'DXT5' : (txd.RasterFormat.RASTER_4444, txd.D3DFormat.D3D_DXT5, 16),
+    'PAL8' : (txd.RasterFormat.RASTER_8888, txd.D3DFormat.D3DFMT_P8, 8),
+    'PAL4' : (txd.RasterFormat.RASTER_8888, txd.D3DFormat.D3DFMT_P8, 8),
+}
+
+# Used palette entries of the paletted formats. D3D9 has no 4 bit indexed
+# format, so PAL4 is stored like PAL8 with one index byte per pixel and a
+# 32 entry palette, of which the first 16 are used.
+palette_colors = {
+    'PAL8' : 256,
+    'PAL4' : 16,
+}
+
 #######################################################
 class txd_exporter:
 
     mass_export = False
     only_used_textures = True
+    texture_format = 'NONE'
+    generate_mipmaps = False
+    dither = False
     version = None
     file_name = ""
     path = ""
@@ -36,15 +58,73 @@ class txd_exporter:
 
     #######################################################
     @staticmethod
-    def _create_texture_native_from_image(image, image_name):
-        pixels = list(image.pixels)
+    def _image_to_rgba(image):
         width, height = image.size
+        size = width * height * 4
+
+        if bpy.app.version >= (2, 83, 0):
+            if numpy is not None:
+                pixels = numpy.empty(size, numpy.float32)
+            else:
+                pixels = array('f', bytes(size * 4))
+            image.pixels.foreach_get(pixels)
+        else:
+            pixels = image.pixels[:]
+
+        # Quantize and flip rows, Blender images are stored bottom row first
+        if numpy is not None:
+            pixels = numpy.asarray(pixels, numpy.float64) * 0xff
+            pixels = numpy.rint(pixels, out=pixels).clip(0, 0xff).astype(numpy.uint8)
+            return pixels.reshape(height, width * 4)[::-1].tobytes()
+
+        row_len = width * 4
+        pixels = bytes(min(max(round(value * 0xff), 0), 0xff) for value in pixels)
+        return b''.join(pixels[offset:offset+row_len]
+                        for offset in range((height - 1) * row_len, -1, -row_len))
+
+    #######################################################
+    @staticmethod
+    def _get_texture_format(rgba_data):
+        self = txd_exporter
+
+        alpha = rgba_data[3::4]
+        has_alpha = alpha.count(0xff) != len(alpha)
+
+        # The DXT encoder and the palette quantizer need NumPy
+        if self.texture_format == 'NONE' or numpy is None:
+            return 'NONE', True
+
+        if self.texture_format == 'AUTO':
+            # Opaque and one bit alpha fit in DXT1, smooth alpha needs DXT5
+            if has_alpha and alpha.translate(None, b'\x00\xff'):
+                return 'DXT5', True
+            return 'DXT1', has_alpha
 
-        rgba_data = bytearray()
-        for h in range(height - 1, -1, -1):
-            offset = h * width * 4
-            row_pixels = pixels[offset:offset + width * 4]
-            rgba_data.extend(int(round(p * 0xff)) for p in row_pixels)
+        return self.texture_format, has_alpha
+
+    #######################################################
+    @staticmethod
+    def _encode_pixels(rgba_data, width, height, texture_format, has_alpha, palette):
+        if texture_format in ('PAL8', 'PAL4'):
+            colors = palette_colors[texture_format]
+            return ImageEncoder.rgba_to_pal(
+                rgba_data, width, height, palette[:colors * 4], 8, txd_exporter.dither
+            )
+        elif texture_format == 'DXT1':
+            return ImageEncoder.rgba_to_bc1(rgba_data, width, height, has_alpha)
+        elif texture_format == 'DXT3':
+            return ImageEncoder.rgba_to_bc2(rgba_data, width, height)
+        elif texture_format == 'DXT5':
+            return ImageEncoder.rgba_to_bc3(rgba_data, width, height)
+
+        return ImageEncoder.rgba_to_bgra8888(rgba_data)
+
+    #######################################################
+    @staticmethod
+    def _create_texture_native_from_image(image, image_name):
+        width, height = image.size
+        rgba_data = txd_exporter._image_to_rgba(image)
+        texture_format, has_alpha = txd_exporter._get_texture_format(rgba_data)
 
         texture_native = txd.TextureNative()
         texture_native.platform_id = NativePlatformType.D3D9
@@ -59,28 +139,52 @@ class txd_exporter:
         texture_native.name = clean_name
         texture_native.mask = ""
         
-        # Raster format flags for RGBA8888: format type (8888=5) at bit 8-11, no mipmaps, no palette
-        texture_native.raster_format_flags = txd.RasterFormat.RASTER_8888 << 8
-        texture_native.d3d_format = txd.D3DFormat.D3D_8888
+        # Raster format type at bit 8-11, palette type at bit 13-14
+        raster_format, d3d_format, depth = texture_formats[texture_format]
+        if texture_format == 'DXT1' and has_alpha:
+            raster_format = txd.RasterFormat.RASTER_1555
+
+        texture_native.raster_format_flags = raster_format << 8
+        if texture_format == 'PAL8':
+            texture_native.raster_format_flags |= txd.PaletteType.PALETTE_8 << 13
+        elif texture_format == 'PAL4':
+            texture_native.raster_format_flags |= txd.PaletteType.PALETTE_4 << 13
+        texture_native.d3d_format = d3d_format
         texture_native.width = width
         texture_native.height = height
-        texture_native.depth = 32
-        texture_native.num_levels = 1
+        texture_native.depth = depth
         texture_native.raster_type = 4  # Texture
         
         texture_native.platform_properties = type('PlatformProperties', (), {
-            'alpha': True,
+            'alpha': has_alpha,
             'cube_texture': False,
             'auto_mipmaps': False,
-            'compressed': False
+            'compressed': texture_format in ('DXT1', 'DXT3', 'DXT5')
         })()
         
-        # No palette for RGBA8888 format
-        texture_native.palette = b''
+        # One palette for all levels, quantized from the top one
+        if texture_format in ('PAL8', 'PAL4'):
+            colors = palette_colors[texture_format]
+            palette = ImageEncoder.median_cut(rgba_data, colors)
+            texture_native.palette = palette.ljust(max(colors, 32) * 4, b'\0')
+        else:
+            texture_native.palette = b''
         
-        # Convert RGBA to BGRA8888 format
-        pixel_data = ImageEncoder.rgba_to_bgra8888(rgba_data)
-        texture_native.pixels = [pixel_data]
+        # Mipmap chain down to 1x1, each level filtered from the previous one
+        texture_native.pixels = []
+        while True:
+            texture_native.pixels.append(txd_exporter._encode_pixels(
+                rgba_data, width, height, texture_format, has_alpha,
+                texture_native.palette
+            ))
+
+            if not txd_exporter.generate_mipmaps or (width == 1 and height == 1):
+                break
+            rgba_data, width, height = ImageEncoder.downsample(rgba_data, width, height)
+
+        texture_native.num_levels = len(texture_native.pixels)
+        if texture_native.num_levels > 1:
+            texture_native.raster_format_flags |= 0x8000 # has mipmaps
         
         return texture_native
 
@@ -208,6 +312,9 @@ def export_txd(options):
 
     txd_exporter.mass_export        = options.get('mass_export', False)
     txd_exporter.only_used_textures = options.get('only_used_textures', True)
+    txd_exporter.texture_format     = options.get('texture_format', 'NONE')
+    txd_exporter.generate_mipmaps   = options.get('generate_mipmaps', False)
+    txd_exporter.dither             = options.get('dither', False)
     txd_exporter.version            = options.get('version', 0x36003)
 
     txd_exporter.path               = options['directory']
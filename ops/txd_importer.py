@@ -16,19 +16,31 @@
 
 import bpy
 import os
+from array import array
 
+from .texture_cache import TextureCache, decode_level
 from ..gtaLib import txd
 
+# Pixels are converted through NumPy when it's there, array('f') otherwise
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_unit_floats = [b / 0xff for b in range(256)]
+
 #######################################################
 class txd_importer:
 
     skip_mipmaps = True
     pack = True
+    cache = None
 
     __slots__ = [
         'txd',
         'images',
-        'file_name'
+        'file_name',
+        'file_key'
     ]
 
     #######################################################
@@ -39,16 +51,31 @@ class txd_importer:
         self.txd = None
         self.images = {}
         self.file_name = ""
+        self.file_key = None
+
+    #######################################################
+    def _image_pixels(rgba, width, height):
+        # Blender images are stored bottom row first with float channels
+        if numpy is not None:
+            pixels = numpy.frombuffer(rgba, numpy.uint8, width * height * 4)
+            pixels = pixels.reshape(height, width * 4)[::-1].astype(numpy.float32)
+            pixels /= 0xff
+            return pixels.ravel()
+
+        row_len = width * 4
+        rows = [rgba[offset:offset+row_len]
+                for offset in range((height - 1) * row_len, -1, -row_len)]
+        return array('f', map(_unit_floats.__getitem__, b''.join(rows)))
 
     #######################################################
     def _create_image(name, rgba, width, height, pack=False):
-        pixels = []
-        for h in range(height - 1, -1, -1):
-            offset = h * width * 4
-            pixels += list(map(lambda b: b / 0xff, rgba[offset:offset+width*4]))
+        pixels = txd_importer._image_pixels(rgba, width, height)
 
         image = bpy.data.images.new(name, width, height, alpha=True)
-        image.pixels = pixels
+        if bpy.app.version >= (2, 83, 0):
+            image.pixels.foreach_set(pixels)
+        else:
+            image.pixels = pixels
 
         if pack:
             image.pack()
@@ -70,10 +97,13 @@ class txd_importer:
                 image_name = "%s/%s/%d" % (txd_name, tex.name, level)
                 image = bpy.data.images.get(image_name)
                 if not image:
+                    width, height, rgba = decode_level(
+                        tex, level, self.cache, self.file_key
+                    )
                     image = txd_importer._create_image(image_name,
-                                                        tex.to_rgba(level),
-                                                        tex.get_width(level),
-                                                        tex.get_height(level),
+                                                        rgba,
+                                                        width,
+                                                        height,
                                                         self.pack)
                 images.append(image)
 
@@ -97,14 +127,47 @@ class txd_importer:
             self.images[tex.name] = images
 
     #######################################################
-    def import_txd(file_name):
+    def import_decoded_textures(textures):
+        self = txd_importer
+
+        txd_name = os.path.basename(self.file_name).lower()
+
+        for tex_name, levels in textures:
+            images = []
+
+            for level, (width, height, rgba) in enumerate(levels):
+                image_name = "%s/%s/%d" % (txd_name, tex_name, level)
+                image = bpy.data.images.get(image_name)
+                if not image:
+                    image = txd_importer._create_image(image_name,
+                                                        rgba,
+                                                        width,
+                                                        height,
+                                                        self.pack)
+                images.append(image)
+
+            self.images[tex_name] = images
+
+    #######################################################
+    def import_txd(file_name, textures=None):
         self = txd_importer
         self._init()
 
-        self.txd = txd.txd()
-        self.txd.load_file(file_name)
         self.file_name = file_name
 
+        # Textures already decoded by map_prefetch.decode_txd
+        if textures is not None:
+            self.import_decoded_textures(textures)
+            return
+
+        with open(file_name, mode='rb') as file:
+            data = file.read()
+
+        self.txd = txd.txd()
+        self.txd.load_memory(data)
+        if self.cache is not None:
+            self.file_key = self.cache.file_key(data)
+
         self.import_textures()
 
 #######################################################
@@ -112,7 +175,8 @@ def import_txd(options):
 
     txd_importer.skip_mipmaps = options['skip_mipmaps']
     txd_importer.pack = options['pack']
+    txd_importer.cache = TextureCache() if options.get('use_cache') else None
 
-    txd_importer.import_txd(options['file_name'])
+    txd_importer.import_txd(options['file_name'], options.get('textures'))
 
     return txd_importer